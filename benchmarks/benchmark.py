@@ -0,0 +1,446 @@
+#  benchmark.py
+#  time the hot paths of the Snap! add-on on synthetic scenes
+#
+#  (c) 2021 - 2025 Michel Anders (varkenvarken)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Benchmarks for Snap!
+
+Runs headless, either inside Blender:
+
+    blender -b --factory-startup -P benchmarks/benchmark.py -- --objects 100 1000
+
+or with the bpy module from PyPI:
+
+    python benchmarks/benchmark.py --objects 100 1000
+
+For every combination of object count, number of extra snap-points and
+with or without tags a synthetic scene is generated: a square grid of empties
+whose base points touch those of their neighbors, with the extra points
+scattered inside each object. On each scene the following are timed:
+
+    index_build       building the snap index from scratch (first modal invoke)
+    index_refresh     updating the snap index after one object moved
+    invoke            the rest of the modal invoke (the arrays of the active object)
+    mousemove         one candidate search while dragging
+    mousemove_aligned the same, scoring the orientation as well
+    flip_pair         finding the snap-point to flip to
+    select_all        Select neighbors with All, starting from a single object
+    draw_gizmos       the cpu side of drawing the gizmos of all objects
+    draw_labels       the cpu side of drawing and decluttering all labels
+    draw_overview     the cpu side of drawing the overview of all snap-points
+    assemble_chain    assemble() of all objects in a single chain
+    assemble_wide     assemble() of all objects to a single one
+    copy              Copy snap-points from the active object to all others
+
+Every timing is repeated and the best, median and mean times in seconds are
+written to a JSON file, together with the versions of Snap!, Blender and
+numpy. Pass --compare with the JSON file of an earlier run to print how much
+faster or slower each timing has become.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+from datetime import datetime, timezone
+from math import radians, tan
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+from types import SimpleNamespace
+
+# the add-on is loaded from this repository, not from the installed add-ons
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "code"))
+
+import bpy  # noqa: E402
+
+# only importable once bpy is
+import addon_utils  # noqa: E402
+import numpy as np  # noqa: E402
+from mathutils import Matrix, Vector  # noqa: E402
+
+BASE_POINTS = (
+    # location, direction, up
+    ((1, 0, 0), (1, 0, 0), (0, 0, 1)),
+    ((-1, 0, 0), (-1, 0, 0), (0, 0, 1)),
+    ((0, 1, 0), (0, 1, 0), (0, 0, 1)),
+    ((0, -1, 0), (0, -1, 0), (0, 0, 1)),
+)
+TAGS = "abcdefgh"
+
+
+def arguments():
+    # inside Blender our arguments follow a --
+    argv = sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        description="Time the hot paths of Snap! on synthetic scenes."
+    )
+    parser.add_argument(
+        "--objects",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="number of objects in a scene",
+    )
+    parser.add_argument(
+        "--base",
+        type=int,
+        choices=range(1, 5),
+        default=4,
+        help="number of enabled base points per object",
+    )
+    parser.add_argument(
+        "--extras",
+        type=int,
+        nargs="+",
+        default=[0, 8],
+        help="number of extra points per object",
+    )
+    parser.add_argument(
+        "--tags",
+        choices=("off", "on", "both"),
+        default="both",
+        help="generate scenes with or without tags on the snap-points",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="number of times to repeat each timing"
+    )
+    parser.add_argument(
+        "--calls",
+        type=int,
+        default=200,
+        help="number of calls per timing for the per-call benchmarks",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=42, help="seed for the random generator"
+    )
+    parser.add_argument(
+        "--output",
+        default="snapper-benchmark.json",
+        help="the JSON file to write the results to",
+    )
+    parser.add_argument(
+        "--compare", help="the JSON file of an earlier run to compare the results with"
+    )
+    return parser.parse_args(argv)
+
+
+def make_scene(nobjects, nbase, nextras, tags, rng):
+    """
+    Replace all objects by a grid of empties with snap-points.
+
+    Returns the list of objects and the length of a side of the grid.
+    """
+    bpy.data.batch_remove(bpy.data.objects)
+    collection = bpy.context.scene.collection
+    side = int(np.ceil(np.sqrt(nobjects)))
+    obs = []
+    for i in range(nobjects):
+        ob = bpy.data.objects.new(f"snap{i}", None)
+        collection.objects.link(ob)
+        ob.location = (2 * (i % side), 2 * (i // side), 0)
+        snapper = ob.snapper
+        snapper.snapper = True
+        for n, pt in enumerate("ABCD"):
+            location, direction, up = BASE_POINTS[n]
+            setattr(snapper, f"{pt}_disable", n >= nbase)
+            setattr(snapper, f"{pt}_location", location)
+            setattr(snapper, f"{pt}_direction", direction)
+            setattr(snapper, f"{pt}_up", up)
+            if tags:
+                # opposite points fit each other
+                setattr(snapper, f"{pt}_tags", "ab"[n % 2])
+                setattr(snapper, f"{pt}_accepttags", "ba"[n % 2])
+        for _ in range(nextras):
+            point = ob.snappoints.add()
+            point.location = [rng.uniform(-0.9, 0.9) for _ in range(3)]
+            direction = Vector([rng.uniform(-1, 1) for _ in range(3)]).normalized()
+            point.direction = direction
+            point.up = direction.orthogonal().normalized()
+            if tags:
+                point.tags = rng.choice(TAGS)
+                point.accepttags = ",".join(rng.sample(TAGS, 2))
+        obs.append(ob)
+    bpy.context.view_layer.update()
+    return obs, side
+
+
+def fake_view(side):
+    """
+    Return a region and region data for a 1920x1080 view of the whole grid from above.
+    """
+    region = SimpleNamespace(width=1920, height=1080)
+    fov = radians(50)
+    near, far = 0.1, 100000.0
+    f = 1 / tan(fov / 2)
+    aspect = region.width / region.height
+    projection = Matrix(
+        (
+            (f / aspect, 0, 0, 0),
+            (0, f, 0, 0),
+            (0, 0, (far + near) / (near - far), 2 * far * near / (near - far)),
+            (0, 0, -1, 0),
+        )
+    )
+    center = Vector((side - 1, side - 1, side * 2 / tan(fov / 2) + 10))
+    rv3d = SimpleNamespace(perspective_matrix=projection @ Matrix.Translation(-center))
+    return region, rv3d
+
+
+def timed(function, repeat, setup=None, calls=1):
+    """
+    Time function, repeat times, and return statistics in seconds per call.
+
+    setup is called before every repetition and not timed.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        for _ in range(calls):
+            function()
+        times.append((perf_counter() - start) / calls)
+    return {
+        "best": min(times),
+        "median": median(times),
+        "mean": mean(times),
+        "calls": calls,
+        "repeat": repeat,
+    }
+
+
+def deselect(obs):
+    for ob in obs:
+        ob.select_set(False)
+
+
+def run_scene(snapper, obs, side, tags, args, rng):
+    """
+    Run all benchmarks on a scene and return a dict with the timings.
+    """
+    view_layer = bpy.context.view_layer
+    prefs = bpy.context.preferences.addons["snapper"].preferences
+    snap_index = snapper.snap_index
+    timings = {}
+
+    # the object being dragged, in the middle of the grid
+    active = obs[len(obs) // 2]
+    exclude = {active.as_pointer()}
+
+    timings["index_build"] = timed(
+        lambda: snap_index.refresh(view_layer, ignore=exclude),
+        args.repeat,
+        setup=snapper.gizmo_cache_clear,
+    )
+
+    # the index ignores the active object, moving it would time nothing
+    others = [ob for ob in obs if ob != active]
+
+    def move_one():
+        ob = rng.choice(others)
+        ob.location.z += 0.001
+        view_layer.update()
+
+    timings["index_refresh"] = timed(
+        lambda: snap_index.refresh(view_layer, ignore=exclude),
+        args.repeat,
+        setup=move_one,
+    )
+
+    def invoke():
+        snap_index.refresh(view_layer, ignore=exclude)
+        snapper.snappoint_arrays(active)
+        snapper.snappoint_ids(active)
+        snapper.mask_array(snapper.snappoint_tags(active))
+
+    timings["invoke"] = timed(invoke, args.repeat)
+
+    snappoints = snapper.snappoint_arrays(active)
+    from_tags = snapper.mask_array(snapper.snappoint_tags(active)) if tags else None
+    positions = [
+        Matrix.Translation(
+            (rng.uniform(0, 2 * side), rng.uniform(0, 2 * side), rng.uniform(-1, 1))
+        )
+        for _ in range(args.calls)
+    ]
+
+    def mousemove(direction_weight=0.0, up_weight=0.0):
+        matrix = positions[rng.randrange(len(positions))]
+        snapper.closest_snappoint_pair(
+            matrix,
+            snappoints,
+            exclude,
+            from_tags,
+            prefs.snapradius,
+            prefs.flip,
+            direction_weight,
+            up_weight,
+        )
+
+    timings["mousemove"] = timed(mousemove, args.repeat, calls=args.calls)
+    timings["mousemove_aligned"] = timed(
+        lambda: mousemove(1.0, 0.5), args.repeat, calls=args.calls
+    )
+
+    timings["flip_pair"] = timed(
+        lambda: snapper.flip_pair(rng.choice(obs), "A", view_layer),
+        args.repeat,
+        calls=args.calls,
+    )
+
+    def select_all():
+        with bpy.context.temp_override(
+            active_object=active, object=active, selected_objects=[active]
+        ):
+            bpy.ops.object.snapper_select(all=True)
+
+    def select_setup():
+        deselect(obs)
+        active.select_set(True)
+
+    timings["select_all"] = timed(select_all, args.repeat, setup=select_setup)
+
+    region, rv3d = fake_view(side)
+
+    def draw_gizmos():
+        gizmo = snapper.combined_gizmo(obs)
+        full, dots = snapper.gizmo_lod(gizmo, prefs, region, rv3d)
+        snapper.gizmo_geometry_arrays(gizmo, prefs, full, dots)
+
+    def draw_gizmos_setup():
+        snapper.gizmo_cache.clear()
+        snapper.combined_cache.clear()
+
+    timings["draw_gizmos"] = timed(draw_gizmos, args.repeat, setup=draw_gizmos_setup)
+
+    def draw_labels():
+        snapper.label_layout(obs, active, prefs, region, rv3d)
+
+    timings["draw_labels"] = timed(draw_labels, args.repeat)
+
+    timings["draw_overview"] = timed(
+        lambda: snapper.overview_geometry(view_layer, prefs),
+        args.repeat,
+        setup=snapper.overview_cache.clear,
+    )
+
+    # every object snapped to the previous one, a single connection per level
+    chain = [
+        snapper.Connection(ob, "B", target, "A") for target, ob in zip(obs, obs[1:])
+    ]
+    timings["assemble_chain"] = timed(
+        lambda: snapper.assemble(chain, apply=False), args.repeat
+    )
+    # every object snapped to the first one, all connections in a single level
+    wide = [snapper.Connection(ob, "B", obs[0], "A") for ob in obs[1:]]
+    timings["assemble_wide"] = timed(
+        lambda: snapper.assemble(wide, apply=False), args.repeat
+    )
+
+    # last, because it changes the snap-points of all objects
+    def copy():
+        with bpy.context.temp_override(
+            active_object=active, object=active, selected_objects=obs
+        ):
+            bpy.ops.object.snapper_copy()
+
+    def copy_setup():
+        # the extra points of the active object are the ones being copied
+        for ob in obs:
+            if ob != active:
+                ob.snappoints.clear()
+
+    timings["copy"] = timed(copy, args.repeat, setup=copy_setup)
+    return timings
+
+
+def compare(results, path):
+    """
+    Print the ratio of each timing to the same timing in an earlier run.
+    """
+    with open(path) as f:
+        earlier = json.load(f)
+    scenes = {tuple(r["scene"].values()): r["timings"] for r in earlier["results"]}
+    print(
+        f"compared to {path} (snapper {earlier['snapper']}), ratios of the best times (below 1 is faster):"
+    )
+    for result in results:
+        old = scenes.get(tuple(result["scene"].values()))
+        if old is None:
+            continue
+        ratios = ", ".join(
+            f"{name} {timing['best'] / old[name]['best']:.2f}"
+            for name, timing in result["timings"].items()
+            if name in old and old[name]["best"] > 0
+        )
+        print(f"  {result['scene']}: {ratios}")
+
+
+def main():
+    args = arguments()
+    rng = random.Random(args.seed)
+
+    addon_utils.enable("snapper", default_set=True)
+    import snapper
+
+    # undo pushes of the operators would dominate the timings
+    bpy.context.preferences.edit.use_global_undo = False
+
+    tags = {"off": (False,), "on": (True,), "both": (False, True)}[args.tags]
+    results = []
+    for nobjects in args.objects:
+        for nextras in args.extras:
+            for tagged in tags:
+                scene = {
+                    "objects": nobjects,
+                    "base": args.base,
+                    "extras": nextras,
+                    "tags": tagged,
+                }
+                start = perf_counter()
+                obs, side = make_scene(nobjects, args.base, nextras, tagged, rng)
+                print(f"{scene} created in {perf_counter() - start:.2f}s")
+                timings = run_scene(snapper, obs, side, tagged, args, rng)
+                for name, timing in timings.items():
+                    print(f"  {name:18} {timing['best'] * 1000:10.3f} ms")
+                results.append({"scene": scene, "timings": timings})
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "snapper": ".".join(map(str, snapper.bl_info["version"])),
+                "blender": bpy.app.version_string,
+                "numpy": np.__version__,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "arguments": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,9 +31,11 @@ bl_info = {
     "tracker_url": "",
     "category": "Object",
 }
+from collections import deque, namedtuple
 from fnmatch import fnmatchcase
-from functools import partial
+from functools import partial, wraps
 from math import cos, degrees, isclose, pi, radians, sin
+from time import perf_counter
 
 import blf
 import bpy
@@ -49,26 +51,46 @@ from bpy.props import (
     PointerProperty,
     StringProperty,
 )
+from bpy.app.handlers import persistent
 from bpy.types import Menu, PropertyGroup
 from bpy_extras import view3d_utils
+from bpy_extras.io_utils import ExportHelper
 from gpu_extras.batch import batch_for_shader
 from gpu_extras.presets import draw_circle_2d
 from mathutils import Matrix, Quaternion, Vector, geometry, kdtree
 
+from . import core
+from .core import SnapFrame
 from .utils import load_icons
 
 POINTS = ("A", "B", "C", "D")
 DISK_SEGMENTS = 32
+DOT_SIZE = 5
 
-uniform_shader = gpu.shader.from_builtin("UNIFORM_COLOR")
-smooth_shader_2d = gpu.shader.from_builtin("SMOOTH_COLOR")
+# builtin shaders and custom icons are created on first use, so that importing
+# and registering the add-on in background mode never touches the gpu module
+shaders = {}
+icons = None
 
 
-def draw_line(p0, p1, color):
-    batch = batch_for_shader(uniform_shader, "LINES", {"pos": [p0, p1]})
-    uniform_shader.bind()
-    uniform_shader.uniform_float("color", color)
-    batch.draw(uniform_shader)
+def get_shader(name):
+    """
+    Return the builtin shader with the given name, creating it on first use.
+    """
+    shader = shaders.get(name)
+    if shader is None:
+        shader = shaders[name] = gpu.shader.from_builtin(name)
+    return shader
+
+
+def get_icons():
+    """
+    Return the preview collection with the custom icons, loading it on first use.
+    """
+    global icons
+    if icons is None:
+        icons = load_icons()
+    return icons
 
 
 unit_circle = np.array(
@@ -103,129 +125,1182 @@ for i in range(N):
     )
 
 
+# cached unit disk batches, one for each highlight color, see draw_disk()
+disk_cache = {}
+
+
 def draw_disk(pos, radius, color):
-    # print("draw_disk", pos, radius, color)
-    circle = (unit_circle * radius + np.array((pos.x, pos.y), dtype=np.float32))[
-        indices
+    """
+    Draw a disk that fades from color at its center to transparent at its edge.
+
+    The unit disk batch for a color is built once, its position and size are
+    set with the model view matrix.
+    """
+    key = tuple(color)
+    batch = disk_cache.get(key)
+    if batch is None:
+        # the highlight colors only change when the preferences are edited
+        if len(disk_cache) >= 8:
+            disk_cache.clear()
+        colors[:, :3] = color
+        colors[0, 3] = 1
+        colors[1:, 3] = 0
+        batch = disk_cache[key] = batch_for_shader(
+            get_shader("SMOOTH_COLOR"),
+            "TRIS",
+            {
+                "pos": unit_circle[indices].reshape(-1, 2),
+                "color": colors[indices].reshape(-1, 4),
+            },
+        )
+    with gpu.matrix.push_pop():
+        gpu.matrix.translate((pos.x, pos.y))
+        gpu.matrix.scale((radius, radius))
+        shader = get_shader("SMOOTH_COLOR")
+        shader.bind()
+        batch.draw(shader)
+
+
+def cone_vertices(pos, direction, scale):
+    """
+    Return the triangles of the arrowheads for n axes in one go.
+
+    Every arrowhead is a copy of tcone, rotated to point along direction,
+    scaled and moved to pos. pos and direction are (n, 3) arrays and scale
+    has shape (n,). The result is an (n * len(tcone), 3) array.
+    """
+    length = np.linalg.norm(direction, axis=1)[:, np.newaxis]
+    d = direction / np.maximum(length, 1e-12)
+    # a helper axis that is never (close to) parallel to the direction
+    helper = np.where(
+        np.abs(d[:, :1]) < 0.9,
+        np.array((1, 0, 0), dtype=np.float32),
+        np.array((0, 1, 0), dtype=np.float32),
+    )
+    u = np.cross(helper, d)
+    u /= np.linalg.norm(u, axis=1)[:, np.newaxis]
+    v = np.cross(d, u)
+    # rows of rot are the images of the x, y and z axes of the cone
+    rot = np.stack((u, v, d), axis=1)
+    csize = 0.06 * scale
+    rcone = np.einsum("vj,njk->nvk", tcone, rot)
+    rcone *= csize[:, np.newaxis, np.newaxis]
+    rcone += pos[:, np.newaxis, :]
+    return rcone.reshape(-1, 3)
+
+
+def snappoint_arrays(ob):
+    """
+    Return the enabled snap-points of ob as arrays in local space.
+
+    The four base points come first, followed by any extra points.
+    Returns a tuple (location, direction, up, right, scale) where the
+    vector arrays have shape (n, 3) and scale has shape (n,).
+    """
+    base = [pt for pt in POINTS if not getattr(ob.snapper, f"{pt}_disable")]
+    vectors = {}
+    for attr in ("location", "direction", "up", "right"):
+        vectors[attr] = np.array(
+            [getattr(ob.snapper, f"{pt}_{attr}") for pt in base], dtype=np.float32
+        ).reshape(-1, 3)
+    scale = np.array(
+        [getattr(ob.snapper, f"{pt}_gizmoscale") for pt in base], dtype=np.float32
+    )
+
+    nextra = len(ob.snappoints)
+    if nextra:
+        disable = np.empty(nextra, dtype=bool)
+        ob.snappoints.foreach_get("disable", disable)
+        enabled = ~disable
+        for attr in vectors:
+            extra = np.empty(nextra * 3, dtype=np.float32)
+            ob.snappoints.foreach_get(attr, extra)
+            extra.shape = -1, 3
+            vectors[attr] = np.concatenate((vectors[attr], extra[enabled]))
+        extra = np.empty(nextra, dtype=np.float32)
+        ob.snappoints.foreach_get("gizmoscale", extra)
+        scale = np.concatenate((scale, extra[enabled]))
+
+    return (
+        vectors["location"],
+        vectors["direction"],
+        vectors["up"],
+        vectors["right"],
+        scale,
+    )
+
+
+def snappoint_labels(ob):
+    """
+    Return the labels and label colors of the enabled snap-points of ob.
+
+    The order is the same as that of snappoint_arrays(). Returns a list of
+    strings and an (n, 4) array.
+    """
+    labels = []
+    colors = []
+    for pt in POINTS:
+        if not getattr(ob.snapper, f"{pt}_disable"):
+            labels.append(getattr(ob.snapper, f"{pt}_label"))
+            colors.append(getattr(ob.snapper, f"{pt}_labelcolor"))
+    for point in ob.snappoints:
+        if not point.disable:
+            labels.append(point.label)
+            colors.append(point.labelcolor)
+    return labels, np.array(colors, dtype=np.float32).reshape(-1, 4)
+
+
+def transform_points(matrix, points, dtype=np.float32):
+    """
+    Transform an (n, 3) array of points by a 4x4 matrix.
+    """
+    m = np.array(matrix, dtype=dtype)
+    return points @ m[:3, :3].T + m[:3, 3]
+
+
+def transform_directions(matrix, vectors, dtype=np.float32):
+    """
+    Rotate an (n, 3) array of vectors by a 4x4 matrix and normalize them.
+    """
+    m = np.array(matrix, dtype=dtype)
+    vectors = vectors @ m[:3, :3].T
+    length = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(length > 0, length, 1)
+
+
+# the world space origin (p0) and the end points of the direction (p1), up (p2)
+# and right (p3) axes of n snap-points as (n, 3) arrays, their scale as an (n,)
+# array and their labels and label colors
+Gizmo = namedtuple("Gizmo", "p0 p1 p2 p3 scale labels labelcolors")
+
+
+def gizmo_endpoints(ob):
+    """
+    Return a Gizmo with the world space geometry of all enabled snap-points of ob.
+    """
+    location, direction, up, right, scale = snappoint_arrays(ob)
+    s = scale[:, np.newaxis]
+    p0 = transform_points(ob.matrix_world, location)
+    p1 = transform_points(ob.matrix_world, location + s * direction)
+    p2 = transform_points(ob.matrix_world, location + s * up)
+    p3 = transform_points(ob.matrix_world, location + s * right)
+    return Gizmo(p0, p1, p2, p3, scale, *snappoint_labels(ob))
+
+
+def snappoint_ids(ob):
+    """
+    Return the identifiers of the enabled snap-points of ob.
+
+    Base points are identified by their letter and extra points by their index
+    in ob.snappoints. The order is the same as that of snappoint_arrays().
+    """
+    ids = [pt for pt in POINTS if not getattr(ob.snapper, f"{pt}_disable")]
+    ids.extend(n for n, point in enumerate(ob.snappoints) if not point.disable)
+    return ids
+
+
+def parse_tags(tags):
+    """
+    Return the set of tags in a comma separated string.
+    """
+    tags = tags.strip()
+    return set(t.strip() for t in tags.split(",")) if len(tags) else set()
+
+
+# every distinct tag is assigned its own bit, see tags_mask()
+tag_bits = {}
+
+
+def tags_mask(tags):
+    """
+    Return the tags in a comma separated string as an integer bitmask.
+
+    Two sets of tags have a tag in common if the bitwise and of their masks is non-zero.
+    """
+    mask = 0
+    for tag in parse_tags(tags):
+        if tag not in tag_bits:
+            tag_bits[tag] = 1 << len(tag_bits)
+        mask |= tag_bits[tag]
+    return mask
+
+
+def snappoint_tags(ob, attr="tags"):
+    """
+    Return the tags (or accepttags) of the enabled snap-points of ob as a list of bitmasks.
+
+    The order is the same as that of snappoint_arrays().
+    """
+    tags = [
+        tags_mask(getattr(ob.snapper, f"{pt}_{attr}"))
+        for pt in POINTS
+        if not getattr(ob.snapper, f"{pt}_disable")
     ]
-    circle.shape = -1, 2
-    colors[:, :3] = color
-    colors[0, 3] = 1
-    colors[1:, 3] = 0
-    circle_colors = colors[indices].reshape(-1, 4)
-    batch = batch_for_shader(
-        smooth_shader_2d, "TRIS", {"pos": circle, "color": circle_colors}
+    tags.extend(
+        tags_mask(getattr(point, attr)) for point in ob.snappoints if not point.disable
     )
-    uniform_shader.bind()
-    batch.draw(smooth_shader_2d)
+    return tags
 
 
-def draw_cone(pos, direction, color, scale):
-    global buf
-    global view_matrix
+def mask_array(masks):
+    """
+    Return a list of tag bitmasks as an array that supports vectorized bitwise and.
 
-    Z = Vector((0, 0, 1))
-    csize = 0.06 * scale
-    rot = np.array(direction.rotation_difference(Z).to_matrix(), dtype=np.float32)
-    rcone = np.empty_like(tcone)
-    # TODO do this all in one go
-    for i in range(len(tcone)):
-        rcone[i] = tcone[i] @ rot
-    rcone = csize * rcone
-    rcone += pos
+    The masks only fit in 64 bit integers as long as there are fewer than 64
+    distinct tags, beyond that an object array of Python ints is returned.
+    """
+    if max(masks, default=0).bit_length() < 64:
+        return np.array(masks, dtype=np.int64)
+    return np.array(masks, dtype=object)
+
+
+# the indexed snap-points of a single object: their ids, their world space
+# locations, directions and up vectors as (n, 3) arrays and their accepttags masks
+IndexedObject = namedtuple(
+    "IndexedObject", "ob ids locations directions ups accepttags"
+)
+
+
+# the KD-tree of the snap index is rebuilt when more than this many entries,
+# or more than this fraction of the entries in the tree, changed since the
+# last build, see SnapIndex
+INDEX_OVERLAY_SIZE = 256
+INDEX_OVERLAY_FRACTION = 0.125
+
+
+class SnapIndex:
+    """
+    A persistent index of the world space locations of all enabled snap-points.
+
+    Besides the locations, the world space directions and up vectors and the
+    accepttags masks are kept in arrays that line up with the entries.
+
+    Objects are reinserted when they move or their snap-points change (see
+    gizmo_cache_update() and snapper_changed()) and the view layer is scanned
+    for added or removed objects only when its collections change. The entries
+    of changed objects are recomputed lazily, when the index is refreshed
+    before a query.
+
+    The entries of unchanged objects are kept in a balanced KD-tree. When an
+    object changes or is removed, its entries are marked dead instead, and the
+    new entries of changed objects are appended to an overlay that is searched
+    by brute force. Only when the overlay and the dead entries grow too large
+    is the KD-tree rebuilt.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # ob.as_pointer() -> IndexedObject for every object in the view layer
+        self.objects = {}
+        # the indexed objects whose entries must be recomputed, keyed on ob.as_pointer()
+        self.stale = {}
+        # the view layer that was last scanned, None if it must be scanned again
+        self.view_layer = None
+        # (ob, pt) for every point in the tree, followed by those in the overlay,
+        # along with the key of ob and whether the entry is still alive
+        self.entries = []
+        self.owners = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.locations = np.empty((0, 3))
+        self.directions = np.empty((0, 3))
+        self.ups = np.empty((0, 3))
+        self.accepttags = mask_array([])
+        # ob.as_pointer() -> (start, stop) of the live entries of each object
+        self.spans = {}
+        # the number of entries in the tree, the ones after that are the overlay
+        self.size = 0
+        # the number of entries that changed since the tree was built
+        self.changes = 0
+        self.tree = kdtree.KDTree(0)
+        self.tree.balance()
+
+    def insert(self, ob):
+        """
+        Mark an indexed object as changed.
+
+        Objects that are new to the view layer are picked up by the next scan.
+        """
+        key = ob.as_pointer()
+        if key in self.objects:
+            self.stale[key] = ob
+
+    def remove(self, key):
+        self.stale.pop(key, None)
+        self.objects.pop(key, None)
+        self.discard(key)
+
+    def discard(self, key):
+        """
+        Mark the entries of an object as dead.
+        """
+        start, stop = self.spans.pop(key, (0, 0))
+        self.alive[start:stop] = False
+        self.changes += stop - start
+
+    def unsync(self):
+        """
+        Mark the view layer for a rescan because objects may have been added or removed.
+        """
+        self.view_layer = None
+
+    def sync(self, view_layer):
+        objects = {ob.as_pointer(): ob for ob in view_layer.objects}
+        for key in self.objects.keys() - objects.keys():
+            self.remove(key)
+        for key, ob in objects.items():
+            if key not in self.objects:
+                self.objects[key] = IndexedObject(ob, [], None, None, None, [])
+                self.stale[key] = ob
+        self.view_layer = view_layer.as_pointer()
+
+    def refresh(self, view_layer, ignore=()):
+        """
+        Bring the index up to date with view_layer.
+
+        Changed objects whose key is in ignore keep their old entries, which is
+        useful for objects that will be excluded from the queries anyway.
+        """
+        if self.view_layer != view_layer.as_pointer():
+            self.sync(view_layer)
+        changed = []
+        for key in [key for key in self.stale if key not in ignore]:
+            ob = self.stale.pop(key)
+            self.discard(key)
+            if ob.snapper.snapper:
+                location, direction, up, *_ = snappoint_arrays(ob)
+                entry = self.objects[key] = IndexedObject(
+                    ob,
+                    snappoint_ids(ob),
+                    transform_points(ob.matrix_world, location, np.float64),
+                    transform_directions(ob.matrix_world, direction, np.float64),
+                    transform_directions(ob.matrix_world, up, np.float64),
+                    snappoint_tags(ob, "accepttags"),
+                )
+                if len(entry.ids):
+                    changed.append((key, entry))
+            else:
+                self.objects[key] = IndexedObject(ob, [], None, None, None, [])
+        if self.changes + sum(len(entry.ids) for _, entry in changed) > max(
+            INDEX_OVERLAY_SIZE, self.size * INDEX_OVERLAY_FRACTION
+        ):
+            self.build()
+        elif changed:
+            self.append(changed)
+
+    def append(self, indexed):
+        """
+        Add the entries of a list of (key, IndexedObject) tuples to the overlay.
+        """
+        n = len(self.entries)
+        owners = []
+        accepttags = []
+        for key, (ob, ids, *_, tags) in indexed:
+            self.entries.extend((ob, pt) for pt in ids)
+            owners.extend([key] * len(ids))
+            accepttags.extend(tags)
+            self.spans[key] = n, n + len(ids)
+            n += len(ids)
+        self.owners = np.concatenate((self.owners, np.array(owners, dtype=np.int64)))
+        self.alive = np.concatenate((self.alive, np.ones(len(owners), dtype=bool)))
+        self.accepttags = np.concatenate((self.accepttags, mask_array(accepttags)))
+        for attr in ("locations", "directions", "ups"):
+            setattr(
+                self,
+                attr,
+                np.concatenate(
+                    [getattr(self, attr)]
+                    + [getattr(entry, attr) for _, entry in indexed]
+                ),
+            )
+        self.changes += len(owners)
+
+    def build(self):
+        """
+        Put the entries of all objects in a new KD-tree and empty the overlay.
+        """
+        self.entries = []
+        self.owners = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.locations = np.empty((0, 3))
+        self.directions = np.empty((0, 3))
+        self.ups = np.empty((0, 3))
+        self.accepttags = mask_array([])
+        self.spans = {}
+        self.append([item for item in self.objects.items() if len(item[1].ids)])
+        self.size = len(self.entries)
+        self.changes = 0
+        self.tree = kdtree.KDTree(self.size)
+        for i, co in enumerate(self.locations.tolist()):
+            self.tree.insert(co, i)
+        self.tree.balance()
+
+    def compact(self):
+        """
+        Fold the overlay into the KD-tree, which pays off before many queries.
+        """
+        if self.changes:
+            self.build()
+
+    def object_locations(self, ob):
+        """
+        Return the indexed snap-point ids and world space locations of ob.
+        """
+        entry = self.objects.get(ob.as_pointer())
+        if entry is None:
+            return [], None
+        return entry.ids, entry.locations
+
+    def candidate(self, index, exclude):
+        # KDTree filters must return a Python bool
+        return bool(
+            self.alive[index]
+            and self.owners[index] not in exclude
+            and self.entries[index][0].visible_get()
+        )
+
+    def overlay(self, co, radius=None):
+        """
+        Return the indices of the live overlay entries and their distances to co.
+
+        If radius is given, only the entries within radius of co are returned.
+        """
+        index = self.size + np.flatnonzero(self.alive[self.size :])
+        distance = np.linalg.norm(
+            self.locations[index] - np.asarray(co, dtype=np.float64), axis=1
+        )
+        if radius is not None:
+            within = distance <= radius
+            index, distance = index[within], distance[within]
+        return index, distance
+
+    def find(self, co, exclude=()):
+        """
+        Return the nearest visible snap-point to co that does not belong to an excluded object.
+
+        exclude is a set of object keys. Returns (location, index, distance) like
+        KDTree.find(), where index refers to self.entries.
+        """
+        nearest = self.tree.find(co, filter=partial(self.candidate, exclude=exclude))
+        index, distance = self.overlay(co)
+        for i in np.argsort(distance).tolist():
+            if nearest[2] is not None and distance[i] >= nearest[2]:
+                break
+            if self.candidate(index[i], exclude):
+                return (
+                    Vector(self.locations[index[i]]),
+                    int(index[i]),
+                    float(distance[i]),
+                )
+        return nearest
+
+    def find_range(self, co, radius, exclude=()):
+        """
+        Return all visible snap-points within radius of co that do not belong to an excluded object.
+
+        Like every query this searches the whole overlay, so call compact()
+        first when making a lot of them.
+        """
+        index, distance = self.overlay(co, radius)
+        found = self.tree.find_range(co, radius) + [
+            (Vector(self.locations[i]), i, d)
+            for i, d in zip(index.tolist(), distance.tolist())
+        ]
+        return [
+            (location, index, distance)
+            for location, index, distance in sorted(found, key=lambda f: f[2])
+            if self.candidate(index, exclude)
+        ]
+
+    def find_candidates(self, co, radius, exclude=()):
+        """
+        Return the indices of all visible snap-points within radius of co that do not belong to an excluded object.
+
+        Unlike find_range() this returns an array and checks the visibility
+        once per object instead of once per snap-point.
+        """
+        index = np.concatenate(
+            (
+                np.fromiter(
+                    (i for _, i, _ in self.tree.find_range(co, radius)), dtype=np.int64
+                ),
+                self.overlay(co, radius)[0],
+            )
+        )
+        owners = self.owners[index]
+        keep = self.alive[index] & ~np.isin(
+            owners, np.fromiter(exclude, dtype=np.int64)
+        )
+        visible = {
+            key: self.objects[key].ob.visible_get()
+            for key in np.unique(owners[keep]).tolist()
+        }
+        keep[keep] = [visible[key] for key in owners[keep].tolist()]
+        return index[keep]
+
+
+# the snap-points of all objects in the view layer, see SnapIndex
+snap_index = SnapIndex()
+
+
+# world space gizmo geometry per object, keyed on ob.as_pointer(), see gizmo_geometry()
+gizmo_cache = {}
+# the combined gizmo geometry of the selected objects, see combined_gizmo()
+combined_cache = {}
+# the combined gizmo batches of the selected objects, see gizmo_batches()
+batch_cache = {}
+# world space locations of all snap-points per object, see overview_points()
+overview_cache = {}
+# the batch with all snap-points in the view layer, see overview_batch()
+overview_batch_cache = {}
+
+
+def gizmo_geometry(ob):
+    """
+    Return the result of gizmo_endpoints(ob), cached until ob or its snap-points change.
+    """
+    key = ob.as_pointer()
+    geometry = gizmo_cache.get(key)
+    if geometry is None:
+        geometry = gizmo_cache[key] = gizmo_endpoints(ob)
+    return geometry
+
+
+def forget_gizmo_geometry(ob):
+    key = ob.as_pointer()
+    if gizmo_cache.pop(key, None) is not None:
+        combined_cache.clear()
+        batch_cache.clear()
+    overview_cache.pop(key, None)
+    overview_batch_cache.clear()
+
+
+@persistent
+def gizmo_cache_update(scene, depsgraph):
+    # forget the geometry of objects that moved (changes to the snap-points
+    # themselves are caught by the update function of their properties)
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Object):
+            forget_gizmo_geometry(update.id.original)
+            if update.is_updated_transform:
+                snap_index.insert(update.id.original)
+        elif isinstance(update.id, bpy.types.Collection):
+            # objects may have been added or removed
+            snap_index.unsync()
+            overview_batch_cache.clear()
+        elif isinstance(update.id, bpy.types.Scene):
+            # hiding or revealing objects only updates the scene
+            overview_batch_cache.clear()
+    if depsgraph.id_type_updated("OBJECT"):
+        ghost_cache.clear()
+
+
+@persistent
+def gizmo_cache_clear(*args):
+    # after loading, undo or a frame change anything may have changed
+    gizmo_cache.clear()
+    combined_cache.clear()
+    batch_cache.clear()
+    overview_cache.clear()
+    overview_batch_cache.clear()
+    ghost_cache.clear()
+    snap_index.clear()
+
+
+def project_points(points, region, rv3d):
+    """
+    Project an (n, 3) array of world space points to region coordinates.
+
+    Returns an (n, 2) array of region coordinates and an (n,) boolean array that
+    is True for points that are in front of the viewer. The coordinates of the
+    other points are meaningless.
+    """
+    m = np.array(rv3d.perspective_matrix, dtype=np.float32)
+    clip = points @ m[:, :3].T + m[:, 3]
+    w = clip[:, 3]
+    infront = w > 0
+    ndc = clip[:, :2] / np.where(infront, w, 1)[:, np.newaxis]
+    coords = (ndc + 1) * 0.5 * (region.width, region.height)
+    return coords, infront
+
+
+def in_region(coords, region):
+    """
+    Return an (n,) boolean array that is True for coordinates inside the region.
+    """
+    return np.all((coords >= 0) & (coords <= (region.width, region.height)), axis=1)
+
+
+def combined_gizmo(obs):
+    """
+    Return a single Gizmo with the geometry of the snap-points of all objects in obs.
+
+    The result is cached until the list of objects or the geometry of any of
+    them changes.
+    """
+    key = tuple(ob.as_pointer() for ob in obs)
+    gizmo = combined_cache.get(key)
+    if gizmo is not None:
+        return gizmo
+    gizmos = [gizmo_geometry(ob) for ob in obs]
+    arrays = [np.concatenate(field) for field in list(zip(*gizmos))[:5]]
+    labels = [label for gizmo in gizmos for label in gizmo.labels]
+    labelcolors = np.concatenate([gizmo.labelcolors for gizmo in gizmos])
+    combined_cache.clear()
+    gizmo = combined_cache[key] = Gizmo(*arrays, labels, labelcolors)
+    return gizmo
+
+
+def gizmo_screen_size(gizmo, region, rv3d):
+    """
+    Return the size in pixels of the gizmos and whether they are visible.
+
+    The size of a gizmo is the length of its longest axis on screen. A gizmo
+    is visible if its origin is in front of the viewer and the bounding
+    rectangle of its projected axes overlaps the region. A visible gizmo
+    with an axis that ends behind the viewer counts as infinitely large.
+    """
+    n = len(gizmo.p0)
+    coords, infront = project_points(
+        np.concatenate((gizmo.p0, gizmo.p1, gizmo.p2, gizmo.p3)), region, rv3d
+    )
+    coords = coords.reshape(4, n, 2)
+    infront = infront.reshape(4, n)
+    size = np.max(np.linalg.norm(coords[1:] - coords[0], axis=2), axis=0)
+    lo = coords.min(axis=0)
+    hi = coords.max(axis=0)
+    overlaps = np.all((hi >= 0) & (lo <= (region.width, region.height)), axis=1)
+    straddling = infront[0] & ~np.all(infront, axis=0)
+    size[straddling] = np.inf
+    return size, infront[0] & (overlaps | straddling)
+
+
+def gizmo_lod(gizmo, prefs, region, rv3d):
+    """
+    Return which snap-points of gizmo to draw with arrows and which as a dot.
+
+    If level of detail is enabled, snap-points outside the view are culled
+    and small ones are drawn as a dot or not at all, and the result is a
+    tuple of two boolean arrays. Otherwise all snap-points are drawn with
+    arrows, whatever the view, and the result is (slice(None), None).
+    """
+    if not prefs.lod:
+        return slice(None), None
+    size, visible = gizmo_screen_size(gizmo, region, rv3d)
+    full = visible & (size >= prefs.lodarrows)
+    dots = visible & (size >= prefs.loddots) & ~full
+    return full, dots
+
+
+def gizmo_geometry_arrays(gizmo, prefs, full=slice(None), dots=None):
+    """
+    Return the vertices and colors of the axis lines, arrowheads and dots of gizmo.
+
+    full and dots select the snap-points drawn with arrows and as a dot, see
+    gizmo_lod(). The result is a tuple (lines, cones, points, npoints) where
+    each of lines, cones and points is a tuple of an (n, 3) array of vertices
+    and an (n, 4) array of colors, or None if there is nothing to draw, and
+    npoints is the number of snap-points drawn.
+    """
+    noarrows = prefs.debug and prefs.noarrows
+    nocones = prefs.debug and prefs.nocones
+    p0, p1, p2, p3, scale = (a[full] for a in gizmo[:5])
+
+    # the color of each vertex of the 3 segments of a single snap-point
+    axis_colors = np.repeat(
+        np.array((prefs.dircolor, prefs.upcolor, prefs.rightcolor), dtype=np.float32),
+        2,
+        axis=0,
+    )
+    lines = None
+    cones = None
+    points = None
+    npoints = len(p0)
+    if len(p0) and not noarrows:
+        # every snap-point contributes 3 segments: p0-p1, p0-p2, p0-p3
+        segments = np.stack((p0, p1, p0, p2, p0, p3), axis=1)
+        colors = np.broadcast_to(axis_colors, segments.shape[:2] + (4,))
+        lines = segments.reshape(-1, 3), colors.reshape(-1, 4)
+    if len(p0) and not nocones:
+        cones = (
+            cone_vertices(
+                np.concatenate((p1, p2, p3)),
+                np.concatenate((p1 - p0, p2 - p0, p3 - p0)),
+                np.tile(scale * prefs.conescale, 3),
+            ),
+            # every arrowhead has len(tcone) vertices of the same color
+            np.repeat(axis_colors[::2], len(p0) * len(tcone), axis=0),
+        )
+    if dots is not None and np.any(dots):
+        npoints += np.count_nonzero(dots)
+        pos = gizmo.p0[dots]
+        colors = np.empty((len(pos), 4), dtype=np.float32)
+        colors[:] = prefs.dircolor
+        points = pos, colors
+    return lines, cones, points, npoints
+
+
+def gizmo_batches(obs, prefs, region, rv3d):
+    """
+    Return the batches with the axis lines, arrowheads and dots of the snap-points of obs.
+
+    Any of them may be None. The number of snap-points drawn with arrows is
+    returned as well. Without level of detail all snap-points are drawn and
+    the batches do not depend on the view at all, it is left to the GPU to clip
+    them. With level of detail, snap-points outside the view are culled and
+    small ones are drawn as a dot or not at all. That classification is redone
+    for every view, but the batches are only rebuilt when it actually changes,
+    or when the list of objects, the preferences that affect them or the
+    geometry of any of the objects changed.
+    """
+    key = (
+        tuple(ob.as_pointer() for ob in obs),
+        tuple(prefs.dircolor),
+        tuple(prefs.upcolor),
+        tuple(prefs.rightcolor),
+        prefs.conescale,
+        prefs.debug and prefs.noarrows,
+        prefs.debug and prefs.nocones,
+        prefs.lod,
+    )
+    gizmo = combined_gizmo(obs)
+    full, dots = gizmo_lod(gizmo, prefs, region, rv3d)
+    if dots is not None:
+        key += (np.packbits(full).tobytes(), np.packbits(dots).tobytes())
+    batches = batch_cache.get(key)
+    if batches is not None:
+        return batches
+
+    lines, cones, points, npoints = gizmo_geometry_arrays(gizmo, prefs, full, dots)
+    smooth_shader = get_shader("SMOOTH_COLOR")
+    if lines is not None:
+        lines = batch_for_shader(
+            smooth_shader, "LINES", {"pos": lines[0], "color": lines[1]}
+        )
+    if cones is not None:
+        cones = batch_for_shader(
+            smooth_shader, "TRIS", {"pos": cones[0], "color": cones[1]}
+        )
+    if points is not None:
+        points = batch_for_shader(
+            get_shader("POINT_FLAT_COLOR"),
+            "POINTS",
+            {"pos": points[0], "color": points[1]},
+        )
+
+    # a few entries are kept around for when several 3d views are visible
+    if len(batch_cache) >= 8:
+        batch_cache.clear()
+    batch_cache[key] = lines, cones, points, npoints
+    return lines, cones, points, npoints
+
+
+def overview_points(ob):
+    """
+    Return the world space locations of all snap-points of ob, cached until ob changes.
+
+    Disabled snap-points are included. Returns an (n, 3) array of locations and
+    an (n,) boolean array that is True for the disabled points.
+    """
+    key = ob.as_pointer()
+    points = overview_cache.get(key)
+    if points is None:
+        location = np.array(
+            [getattr(ob.snapper, f"{pt}_location") for pt in POINTS], dtype=np.float32
+        )
+        disable = np.array(
+            [getattr(ob.snapper, f"{pt}_disable") for pt in POINTS], dtype=bool
+        )
+        nextra = len(ob.snappoints)
+        if nextra:
+            extra = np.empty(nextra * 3, dtype=np.float32)
+            ob.snappoints.foreach_get("location", extra)
+            extra.shape = -1, 3
+            location = np.concatenate((location, extra))
+            extra = np.empty(nextra, dtype=bool)
+            ob.snappoints.foreach_get("disable", extra)
+            disable = np.concatenate((disable, extra))
+        points = overview_cache[key] = (
+            transform_points(ob.matrix_world, location),
+            disable,
+        )
+    return points
+
+
+def cell_keys(cells):
+    """
+    Return a single key for every row of an (n, d) array of integer grid cells.
+
+    Two keys are equal only if the rows are, so np.unique() can be applied to
+    the keys instead of to the rows with axis=0, which is a lot slower. The
+    keys are int64 if the range of the cells allows it, byte strings otherwise.
+    """
+    if not len(cells):
+        return np.empty(0, dtype=np.int64)
+    lo = cells.min(axis=0)
+    extent = cells.max(axis=0) - lo + 1
+    if np.prod(extent, dtype=np.float64) < 2**62:
+        # the cells are numbered in row-major order
+        strides = np.append(np.cumprod(extent[:0:-1])[::-1], 1)
+        return (cells - lo) @ strides.astype(np.int64)
+    cells = np.ascontiguousarray(cells)
+    return cells.view(np.dtype((np.void, cells.itemsize * cells.shape[1]))).ravel()
+
+
+def overview_geometry(view_layer, prefs):
+    """
+    Return the locations and colors of all snap-points of all visible objects in the view layer.
+
+    Every snap-point is colored by its state: disabled, connected (when it
+    coincides with an enabled snap-point of another object) or open. Returns
+    an (n, 3) and an (n, 4) array, or None if there are no snap-points.
+    """
+    points = [
+        overview_points(ob)
+        for ob in view_layer.objects
+        if ob.snapper.snapper and ob.visible_get()
+    ]
+    if not points:
+        return None
+    location, disable = (np.concatenate(a) for a in zip(*points))
+    if not len(location):
+        return None
+
+    colors = np.empty((len(location), 4), dtype=np.float32)
+    colors[:] = prefs.opencolor
+    colors[disable] = prefs.disabledcolor
+    # enabled snap-points that share a location (within the same tolerance as
+    # Select neighbors) are connected
+    enabled = np.flatnonzero(~disable)
+    if len(enabled):
+        cells = np.round(location[enabled] / 0.0001).astype(np.int64)
+        _, inverse, counts = np.unique(
+            cell_keys(cells), return_inverse=True, return_counts=True
+        )
+        colors[enabled[counts[inverse.ravel()] > 1]] = prefs.connectedcolor
+    return location, colors
+
+
+def overview_batch(view_layer, prefs):
+    """
+    Return a batch with all snap-points of all visible objects in the view layer.
+
+    Every snap-point is a single point, colored as described in overview_geometry().
+    Returns the batch, or None if there are no snap-points, and the number of points.
+    """
+    key = (
+        tuple(prefs.connectedcolor),
+        tuple(prefs.opencolor),
+        tuple(prefs.disabledcolor),
+    )
+    batch = overview_batch_cache.get(key)
+    if batch is not None:
+        return batch
+
+    geometry = overview_geometry(view_layer, prefs)
+    if geometry is None:
+        return None, 0
+    location, colors = geometry
     batch = batch_for_shader(
-        uniform_shader,
-        "TRIS",
-        {"pos": rcone},
-        indices=np.arange(len(rcone) * 3, dtype=np.int32).reshape(-1, 3),
+        get_shader("POINT_FLAT_COLOR"), "POINTS", {"pos": location, "color": colors}
     )
-    uniform_shader.bind()
-    uniform_shader.uniform_float("color", color)
-    batch.draw(uniform_shader)
+    overview_batch_cache.clear()
+    overview_batch_cache[key] = batch, len(location)
+    return batch, len(location)
+
+
+# the preview of the objects being snapped, drawn instead of moving them, see DragMixin
+ghost = {"batch": None, "matrix": None}
+# the preview batch of the last group of objects, see ghost_batch()
+ghost_cache = {}
+# the vertex indices of the 12 edges of a bounding box
+BOX_EDGES = np.array(
+    [
+        (0, 1), (1, 2), (2, 3), (3, 0),
+        (4, 5), (5, 6), (6, 7), (7, 4),
+        (0, 4), (1, 5), (2, 6), (3, 7),
+    ],
+    dtype=np.int32,
+)  # fmt: skip
+# the vertex indices of the 12 triangles of the faces of a bounding box
+BOX_TRIS = np.array(
+    [
+        (0, 1, 2), (0, 2, 3), (4, 5, 6), (4, 6, 7),
+        (0, 1, 5), (0, 5, 4), (3, 2, 6), (3, 6, 7),
+        (0, 3, 7), (0, 7, 4), (1, 2, 6), (1, 6, 5),
+    ],
+    dtype=np.int32,
+)  # fmt: skip
+# the corners of a bounding box, in the same order as Object.bound_box
+BOX_CORNERS = np.array(
+    [
+        (0, 0, 0), (0, 0, 1), (0, 1, 1), (0, 1, 0),
+        (1, 0, 0), (1, 0, 1), (1, 1, 1), (1, 1, 0),
+    ],
+    dtype=np.float32,
+)  # fmt: skip
+
+
+def bounding_box(o):
+    """
+    Return the 8 corners of the bounding box of o in its local space.
+
+    For an empty that instances a collection this is the box around the
+    objects in that collection. Returns None if o has no extent, like a
+    plain empty.
+    """
+    collection = o.instance_collection if o.instance_type == "COLLECTION" else None
+    if collection is not None:
+        corners = []
+        for c in collection.all_objects:
+            co = bounding_box(c)
+            if co is not None:
+                corners.append(transform_points(c.matrix_world, co))
+        if not corners:
+            return None
+        co = np.concatenate(corners) - np.array(
+            collection.instance_offset, dtype=np.float32
+        )
+        lo = co.min(axis=0)
+        return lo + BOX_CORNERS * (co.max(axis=0) - lo)
+    co = np.array(o.bound_box, dtype=np.float32)
+    if not np.any(co.max(axis=0) > co.min(axis=0)):
+        return None
+    return co
+
+
+def ghost_batch(ob, obs, boxes=False):
+    """
+    Return a batch with the evaluated geometry of obs in the local space of ob.
+
+    Objects without geometry of their own, like collection instances, are
+    drawn as their bounding box. If boxes is True, the batch contains the edges
+    of the bounding boxes of all of obs instead. Returns None if there is
+    nothing to draw. The batch is cached until any object changes.
+    """
+    key = (tuple(o.as_pointer() for o in obs), boxes)
+    if key in ghost_cache:
+        return ghost_cache[key]
+    inverse = ob.matrix_world.inverted()
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    coords = []
+    indices = []
+    n = 0
+    for o in obs:
+        matrix = inverse @ o.matrix_world
+        if boxes or o.type not in {"MESH", "CURVE", "SURFACE", "FONT", "META"}:
+            co = bounding_box(o)
+            if co is None:
+                continue
+            tris = BOX_EDGES if boxes else BOX_TRIS
+        else:
+            o_eval = o.evaluated_get(depsgraph)
+            mesh = o_eval.to_mesh()
+            if mesh is None:
+                continue
+            mesh.calc_loop_triangles()
+            co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+            mesh.vertices.foreach_get("co", co)
+            co.shape = -1, 3
+            tris = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+            mesh.loop_triangles.foreach_get("vertices", tris)
+            tris.shape = -1, 3
+            o_eval.to_mesh_clear()
+        coords.append(transform_points(matrix, co))
+        indices.append(tris + n)
+        n += len(co)
+    batch = None
+    if coords:
+        batch = batch_for_shader(
+            get_shader("UNIFORM_COLOR"),
+            "LINES" if boxes else "TRIS",
+            {"pos": np.concatenate(coords)},
+            indices=np.concatenate(indices),
+        )
+    ghost_cache.clear()
+    ghost_cache[key] = batch
+    return batch
+
+
+# a bounded log of captured gizmo transformations, see SNAPPER_OT_DumpCapture
+dump_log = deque(maxlen=1000)
+dump_state = {"frames": 0, "frame": 0}
+
+
+def format_dump_log():
+    """
+    Return the captured gizmo transformations as text.
+    """
+    lines = []
+    for frame, name, matrix_world, gizmo in dump_log:
+        lines.append("=" * 20)
+        lines.append(f"{frame = } {name = }")
+        lines.append(f"{matrix_world = }")
+        for i in range(len(gizmo.p0)):
+            lines.append(f"label = {gizmo.labels[i]!r}")
+            lines.append(f"scale = {gizmo.scale[i]}")
+            for p in ("p0", "p1", "p2", "p3"):
+                lines.append(f"{p} = {getattr(gizmo, p)[i]}")
+    return "\n".join(lines) + "\n"
+
+
+STATS_FRAMES = 100
+# the duration in seconds of the most recent calls of each draw handler and
+# the number of things drawn in the current redraw, see draw_handler_stats()
+draw_times = {
+    "view": deque(maxlen=STATS_FRAMES),
+    "pixel": deque(maxlen=STATS_FRAMES),
+}
+draw_counts = {"points": 0, "batches": 0, "labels": 0}
 
 
+def timed(name):
+    """
+    Decorator that records the duration of every call to a draw handler in draw_times.
+    """
+
+    def decorator(handler):
+        @wraps(handler)
+        def timed_handler():
+            start = perf_counter()
+            handler()
+            draw_times[name].append(perf_counter() - start)
+
+        return timed_handler
+
+    return decorator
+
+
+@timed("view")
 def draw_handler_post_view():
     # draw coordinate axes of snappoints on selected objects
     prefs = bpy.context.preferences.addons[__name__].preferences
+    draw_counts["points"] = 0
+    draw_counts["batches"] = 0
+    if ghost["batch"] is not None:
+        with gpu.matrix.push_pop():
+            gpu.matrix.multiply_matrix(ghost["matrix"])
+            uniform_shader = get_shader("UNIFORM_COLOR")
+            uniform_shader.bind()
+            uniform_shader.uniform_float("color", prefs.ghostcolor)
+            gpu.state.blend_set("ALPHA")
+            ghost["batch"].draw(uniform_shader)
+            gpu.state.blend_set("NONE")
+        draw_counts["batches"] += 1
     if prefs.visible:
-        color_direction = prefs.dircolor
-        color_up = prefs.upcolor
-        color_right = prefs.rightcolor
-        for ob in bpy.context.selected_objects:
-            if ob.snapper.snapper:
-                if prefs.debug and prefs.dump:
-                    print("=" * 20)
-                    print(f"{ob.matrix_world = }")
-                for point in POINTS:
-                    if not getattr(ob.snapper, f"{point}_disable"):
-                        loc = Vector(getattr(ob.snapper, f"{point}_location"))
-                        scale = getattr(ob.snapper, f"{point}_gizmoscale")
-                        p0 = ob.matrix_world @ loc
-                        p1 = ob.matrix_world @ (
-                            loc
-                            + scale * Vector(getattr(ob.snapper, f"{point}_direction"))
-                        )
-                        p2 = ob.matrix_world @ (
-                            loc + scale * Vector(getattr(ob.snapper, f"{point}_up"))
-                        )
-                        p3 = ob.matrix_world @ (
-                            loc + scale * Vector(getattr(ob.snapper, f"{point}_right"))
-                        )
-                        # debug info if requested
-                        if prefs.debug and prefs.dump:
-                            print(f"{point = }")
-                            print(f"{loc = }")
-                            print(f"{scale = }")
-                            print(f"{p0 = }")
-                            print(f"{p1 = }")
-                            print(f"{p2 = }")
-                            print(f"{p3 = }")
-                        if not (prefs.debug and prefs.noarrows):
-                            gpu.state.line_width_set(prefs.linewidth)
-                            draw_line(p0, p1, color_direction)
-                            draw_line(p0, p2, color_up)
-                            draw_line(p0, p3, color_right)
-                            gpu.state.line_width_set(1)
-                        if not (prefs.debug and prefs.nocones):
-                            cscale = scale * prefs.conescale
-                            draw_cone(p1, p1 - p0, color_direction, cscale)
-                            draw_cone(p2, p2 - p0, color_up, cscale)
-                            draw_cone(p3, p3 - p0, color_right, cscale)
-                for point in ob.snappoints:
-                    if not point.disable:
-                        loc = Vector(point.location)
-                        scale = point.gizmoscale
-                        p0 = ob.matrix_world @ loc
-                        p1 = ob.matrix_world @ (loc + scale * Vector(point.direction))
-                        p2 = ob.matrix_world @ (loc + scale * Vector(point.up))
-                        p3 = ob.matrix_world @ (loc + scale * Vector(point.right))
-
-                        # debug info if requested
-                        if prefs.debug and prefs.dump:
-                            print(f"{point = }")
-                            print(f"{loc = }")
-                            print(f"{scale = }")
-                            print(f"{p0 = }")
-                            print(f"{p1 = }")
-                            print(f"{p2 = }")
-                            print(f"{p3 = }")
-                        if not (prefs.debug and prefs.noarrows):
-                            gpu.state.line_width_set(prefs.linewidth)
-                            draw_line(p0, p1, color_direction)
-                            draw_line(p0, p2, color_up)
-                            draw_line(p0, p3, color_right)
-                            gpu.state.line_width_set(1)
-                        if not (prefs.debug and prefs.nocones):
-                            cscale = scale * prefs.conescale
-                            draw_cone(p1, p1 - p0, color_direction, cscale)
-                            draw_cone(p2, p2 - p0, color_up, cscale)
-                            draw_cone(p3, p3 - p0, color_right, cscale)
-                if prefs.debug and prefs.dump:
-                    print("=" * 20)
+        if prefs.showall:
+            batch, npoints = overview_batch(bpy.context.view_layer, prefs)
+            if batch is not None:
+                point_shader = get_shader("POINT_FLAT_COLOR")
+                point_shader.bind()
+                gpu.state.point_size_set(prefs.overviewsize)
+                batch.draw(point_shader)
+                gpu.state.point_size_set(1)
+                draw_counts["points"] += npoints
+                draw_counts["batches"] += 1
+        obs = [ob for ob in bpy.context.selected_objects if ob.snapper.snapper]
+        if not obs:
+            return
+        # debug info if requested
+        if prefs.debug and prefs.dump and dump_state["frames"] > 0:
+            dump_state["frames"] -= 1
+            dump_state["frame"] += 1
+            for ob in obs:
+                dump_log.append(
+                    (
+                        dump_state["frame"],
+                        ob.name,
+                        Matrix(ob.matrix_world),
+                        gizmo_geometry(ob),
+                    )
+                )
+        lines, cones, points, npoints = gizmo_batches(
+            obs, prefs, bpy.context.region, bpy.context.space_data.region_3d
+        )
+        draw_counts["points"] += npoints
+        smooth_shader = get_shader("SMOOTH_COLOR")
+        smooth_shader.bind()
+        for batch in (cones, lines, points):
+            if batch is not None:
+                draw_counts["batches"] += 1
+        if cones is not None:
+            cones.draw(smooth_shader)
+        if lines is not None:
+            gpu.state.line_width_set(prefs.linewidth)
+            lines.draw(smooth_shader)
+            gpu.state.line_width_set(1)
+        if points is not None:
+            point_shader = get_shader("POINT_FLAT_COLOR")
+            point_shader.bind()
+            gpu.state.point_size_set(DOT_SIZE)
+            points.draw(point_shader)
+            gpu.state.point_size_set(1)
+
+
+def declutter(coords, candidates, priority, cellsize):
+    """
+    Select at most one label per cell of a screen space grid.
+
+    coords is an (n, 2) array of region coordinates, candidates an array of
+    indices into it and priority an (n,) array. In every cell the candidate
+    with the highest priority is kept, the first one in case of a tie.
+    Returns the indices of the kept labels and the number of candidates
+    in their cells.
+    """
+    cells = np.floor(coords[candidates] / max(cellsize, 1)).astype(np.int64)
+    keys = cell_keys(cells)
+    order = np.lexsort((-priority[candidates], keys))
+    _, first, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    return candidates[order[first]], counts
 
 
+def label_layout(obs, active, prefs, region, rv3d):
+    """
+    Return which labels of the snap-points of obs to draw, where and in what color.
+
+    Labels outside the region are culled and, with level of detail, those of
+    small gizmos fade out or disappear. With decluttering at most one label
+    per cell is kept, and the labels of the active object win. Returns None
+    if there is nothing to draw, or a tuple (gizmo, coords, visible,
+    labelcolors, counts) with the combined gizmo, the (n, 2) region
+    coordinates of the labels, the indices of the ones to draw, the (n, 4)
+    label colors and, when decluttering, the number of labels in the cell of
+    each drawn label.
+    """
+    gizmo = combined_gizmo(obs)
+    coords, visible = project_points(gizmo.p0, region, rv3d)
+    visible &= in_region(coords, region)
+    if prefs.coloroverride:
+        labelcolors = np.empty_like(gizmo.labelcolors)
+        labelcolors[:] = prefs.replacementcolor
+    else:
+        labelcolors = gizmo.labelcolors.copy()
+    if prefs.lod:
+        # labels of small gizmos fade out and eventually disappear
+        size, _ = gizmo_screen_size(gizmo, region, rv3d)
+        fade = max(prefs.labelfade - prefs.labelhide, 1)
+        alpha = np.clip((size - prefs.labelhide) / fade, 0, 1)
+        labelcolors[:, 3] *= alpha
+        visible &= alpha > 0
+    visible = np.flatnonzero(visible)
+    if not len(visible):
+        return None
+    counts = None
+    if prefs.declutter:
+        # the points of the active object win when labels overlap
+        priority = np.concatenate(
+            [np.full(len(gizmo_geometry(ob).p0), int(ob == active)) for ob in obs]
+        )
+        visible, counts = declutter(coords, visible, priority, prefs.declutter_cellsize)
+    coords += prefs.labeloffset
+    return gizmo, coords, visible, labelcolors, counts
+
+
+@timed("pixel")
 def draw_handler_post_pixel():
     prefs = bpy.context.preferences.addons[__name__].preferences
+    draw_counts["labels"] = 0
     if prefs.visible:
         # bgl.glEnable(bgl.GL_BLEND)
         # bgl.glBlendEquation(bgl.GL_FUNC_ADD)
@@ -242,6 +1317,7 @@ def draw_handler_post_pixel():
             )
             if coords_2d:
                 draw_disk(coords_2d, 20, prefs.fromcolor)
+                draw_counts["batches"] += 1
         if to_point:
             coords_2d = view3d_utils.location_3d_to_region_2d(
                 region=bpy.context.region,
@@ -250,54 +1326,91 @@ def draw_handler_post_pixel():
             )
             if coords_2d:
                 draw_disk(coords_2d, 20, prefs.tocolor)
+                draw_counts["batches"] += 1
         # draw labels of snappoints on selected objects
+        obs = [ob for ob in bpy.context.selected_objects if ob.snapper.snapper]
+        if not obs:
+            return
+        layout = label_layout(
+            obs,
+            bpy.context.active_object,
+            prefs,
+            bpy.context.region,
+            bpy.context.space_data.region_3d,
+        )
+        if layout is None:
+            return
+        gizmo, coords, visible, labelcolors, counts = layout
+
         font_id = 0  # NICE TO HAVE: font based on settings
         if prefs.fontshadow:
             blf.enable(font_id, blf.SHADOW)
             blf.shadow(font_id, 5, 0, 0, 0, 0.7)
             blf.shadow_offset(font_id, 2, -2)
-        fontsize = prefs.fontsize
-        offset = Vector(prefs.labeloffset)
-        for ob in bpy.context.selected_objects:
-            if ob.snapper.snapper:
-                for point in POINTS:
-                    if not getattr(ob.snapper, f"{point}_disable"):
-                        p0 = ob.matrix_world @ Vector(
-                            getattr(ob.snapper, f"{point}_location")
-                        )
-                        coords_2d = view3d_utils.location_3d_to_region_2d(
-                            region=bpy.context.region,
-                            rv3d=bpy.context.space_data.region_3d,
-                            coord=p0,
-                        )
-                        if coords_2d:
-                            coords_2d += offset
-                            blf.position(0, *coords_2d, 0)
-                            blf.size(font_id, fontsize)
-                            if prefs.coloroverride:
-                                blf.color(font_id, *(prefs.replacementcolor))
-                            else:
-                                blf.color(
-                                    font_id, *getattr(ob.snapper, f"{point}_labelcolor")
-                                )
-                            blf.draw(font_id, getattr(ob.snapper, f"{point}_label"))
-                for point in ob.snappoints:
-                    if not point.disable:
-                        p0 = ob.matrix_world @ Vector(point.location)
-                        coords_2d = view3d_utils.location_3d_to_region_2d(
-                            region=bpy.context.region,
-                            rv3d=bpy.context.space_data.region_3d,
-                            coord=p0,
-                        )
-                        if coords_2d:
-                            coords_2d += offset
-                            blf.position(0, *coords_2d, 0)
-                            blf.size(font_id, fontsize)
-                            if prefs.coloroverride:
-                                blf.color(font_id, *(prefs.replacementcolor))
-                            else:
-                                blf.color(font_id, *point.labelcolor)
-                            blf.draw(font_id, point.label)
+        blf.size(font_id, prefs.fontsize)
+        draw_counts["labels"] = len(visible)
+        color = None
+        for n, i in enumerate(visible):
+            labelcolor = tuple(labelcolors[i])
+            if labelcolor != color:
+                color = labelcolor
+                blf.color(font_id, *color)
+            blf.position(font_id, coords[i, 0], coords[i, 1], 0)
+            if counts is not None and prefs.declutter_count and counts[n] > 1:
+                blf.draw(font_id, f"{gizmo.labels[i]} +{counts[n] - 1}")
+            else:
+                blf.draw(font_id, gizmo.labels[i])
+
+
+def draw_handler_stats():
+    # show the cost of the other draw handlers if requested
+    prefs = bpy.context.preferences.addons[__name__].preferences
+    if not (prefs.debug and prefs.profile):
+        return
+    lines = []
+    for name, times in draw_times.items():
+        if len(times):
+            ms = 1000 * np.array(times)
+            lines.append(
+                f"{name}: {ms[-1]:.2f} ms  avg {ms.mean():.2f} ms"
+                f"  p95 {np.percentile(ms, 95):.2f} ms"
+            )
+    lines.append(
+        f"points: {draw_counts['points']}  batches: {draw_counts['batches']}"
+        f"  labels: {draw_counts['labels']}"
+    )
+    font_id = 0
+    blf.size(font_id, 14)
+    blf.color(font_id, 1, 1, 1, 1)
+    y = bpy.context.region.height - 60
+    for line in lines:
+        blf.position(font_id, 20, y, 0)
+        blf.draw(font_id, line)
+        y -= 20
+
+
+def snapper_changed(self, context):
+    # self is a property group that belongs to an object
+    forget_gizmo_geometry(self.id_data)
+    snap_index.insert(self.id_data)
+
+
+def redraw_views(context, obs=()):
+    """
+    Redraw all 3d views to show the new state after an operator.
+
+    The cached geometry of the snap-points of obs is forgotten, which is only
+    needed for changes that do not call the update function of a property,
+    like adding or removing extra points. Unlike a view layer update, this
+    does not evaluate the whole scene.
+    """
+    for ob in obs:
+        forget_gizmo_geometry(ob)
+        snap_index.insert(ob)
+    for window in context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == "VIEW_3D":
+                area.tag_redraw()
 
 
 def ensure_ortho_right(self, context, point="A"):
@@ -325,11 +1438,17 @@ class SnapperPointPropertyGroup(bpy.types.PropertyGroup):
         name="label",
         default="Label",
         description="Descriptive label for this snap-point",
+        update=snapper_changed,
     )
     disable: BoolProperty(
-        name="Disable", default=False, description="Disable this snap-point"
+        name="Disable",
+        default=False,
+        description="Disable this snap-point",
+        update=snapper_changed,
+    )
+    location: FloatVectorProperty(
+        name="loc", description="Location", update=snapper_changed
     )
-    location: FloatVectorProperty(name="loc", description="Location")
     direction: FloatVectorProperty(
         name="dir",
         default=(1, 0, 0),
@@ -346,6 +1465,7 @@ class SnapperPointPropertyGroup(bpy.types.PropertyGroup):
         name="right",
         default=Vector((1, 0, 0)).cross(Vector((0, 0, 1))),
         description="Right hand vector (calculated automatically)",
+        update=snapper_changed,
     )
     snapangle: FloatProperty(
         name="angle",
@@ -357,6 +1477,7 @@ class SnapperPointPropertyGroup(bpy.types.PropertyGroup):
         min=radians(0.01),
         max=pi,
         step=100,
+        update=snapper_changed,
     )
     labelcolor: FloatVectorProperty(
         name="color",
@@ -364,6 +1485,7 @@ class SnapperPointPropertyGroup(bpy.types.PropertyGroup):
         default=(1, 1, 1, 1),
         description="Label color",
         subtype="COLOR",
+        update=snapper_changed,
     )
     gizmoscale: FloatProperty(
         name="scale",
@@ -371,21 +1493,24 @@ class SnapperPointPropertyGroup(bpy.types.PropertyGroup):
         description="Size of the snappoint display axes",
         min=0.00001,
         unit="LENGTH",
+        update=snapper_changed,
     )
     tags: StringProperty(
         name="tags",
         default="",
         description="A comma separated list of tags for this snap-point",
+        update=snapper_changed,
     )
     accepttags: StringProperty(
         name="accept tags",
         default="",
         description="A comma separated list of acceptable tags for this snap-point",
+        update=snapper_changed,
     )
 
 
 class SnapperPropertyGroup(bpy.types.PropertyGroup):
-    snapper: BoolProperty(name="Snapper", default=False)
+    snapper: BoolProperty(name="Snapper", default=False, update=snapper_changed)
 
 
 annotations = SnapperPropertyGroup.__annotations__
@@ -395,10 +1520,13 @@ for n, pt in enumerate(POINTS):
     )
     f = globals()[f"{pt}_ensure_ortho_right"]
     annotations[f"{pt}_disable"] = BoolProperty(
-        name="Disable", default=(n > 0), description="Disable this snap-point"
+        name="Disable",
+        default=(n > 0),
+        description="Disable this snap-point",
+        update=snapper_changed,
     )
     annotations[f"{pt}_location"] = FloatVectorProperty(
-        name="loc", description="Location"
+        name="loc", description="Location", update=snapper_changed
     )
     annotations[f"{pt}_direction"] = FloatVectorProperty(
         name="dir", default=(1, 0, 0), update=f, description="Direction"
@@ -410,6 +1538,7 @@ for n, pt in enumerate(POINTS):
         name="right",
         default=Vector((1, 0, 0)).cross(Vector((0, 0, 1))),
         description="Right hand vector (calculated automatically)",
+        update=snapper_changed,
     )
     annotations[f"{pt}_snapangle"] = FloatProperty(
         name="angle",
@@ -421,9 +1550,13 @@ for n, pt in enumerate(POINTS):
         min=radians(0.01),
         max=pi,
         step=100,
+        update=snapper_changed,
     )
     annotations[f"{pt}_label"] = StringProperty(
-        name="label", default=pt, description="Descriptive label for this snap-point"
+        name="label",
+        default=pt,
+        description="Descriptive label for this snap-point",
+        update=snapper_changed,
     )
     annotations[f"{pt}_labelcolor"] = FloatVectorProperty(
         name="color",
@@ -431,6 +1564,7 @@ for n, pt in enumerate(POINTS):
         default=(1, 1, 1, 1),
         description="Label color",
         subtype="COLOR",
+        update=snapper_changed,
     )
     annotations[f"{pt}_gizmoscale"] = FloatProperty(
         name="scale",
@@ -438,16 +1572,19 @@ for n, pt in enumerate(POINTS):
         description="Size of the snappoint display axes",
         min=0.00001,
         unit="LENGTH",
+        update=snapper_changed,
     )
     annotations[f"{pt}_tags"] = StringProperty(
         name="tags",
         default="",
         description="A comma separated list of tags for this snap-point",
+        update=snapper_changed,
     )
     annotations[f"{pt}_accepttags"] = StringProperty(
         name="accept tags",
         default="",
         description="A comma separated list of acceptable tags for this snap-point",
+        update=snapper_changed,
     )
 
 
@@ -463,7 +1600,7 @@ class SNAPPER_PT_Snappoints(bpy.types.Panel):
         return context.active_object is not None
 
     def draw(self, context):
-        global icons
+        icons = get_icons()
         ob = context.active_object
         layout = self.layout
         if not ob.select_get():
@@ -560,10 +1697,13 @@ class SNAPPER_PT_Snappoints(bpy.types.Panel):
 
 def all_operators(layout, context):
     ob = context.active_object
-    layout.prop(bpy.context.preferences.addons[__name__].preferences, "visible")
+    row = layout.row()
+    row.prop(bpy.context.preferences.addons[__name__].preferences, "visible")
+    row.prop(bpy.context.preferences.addons[__name__].preferences, "showall")
     if not (ob and ob.snapper.snapper and ob.select_get()):
         layout.label(text="No object selected")
         return
+    icons = get_icons()
     row = layout.row()
     op = row.operator("object.snapper_snapmodal", icon_value=icons["snap_icon"].icon_id)
     op = row.operator(
@@ -714,7 +1854,7 @@ class SNAPPER_PT_Operators(bpy.types.Panel):
         row.operator(
             "WM_OT_call_menu_pie",
             text="Snap! Pie menu",
-            icon_value=icons["pie_icon"].icon_id,
+            icon_value=get_icons()["pie_icon"].icon_id,
         ).name = "SNAPPER_MT_Pie"
         row.prop(context.preferences.addons[__name__].preferences, "flip")
         row.prop(context.preferences.addons[__name__].preferences, "autoparent")
@@ -769,13 +1909,7 @@ class SNAPPER_OT_PointAdd(bpy.types.Operator):
         scale = max(0.2, min(context.active_object.dimensions))
         pt.gizmoscale = scale
 
-        # all kinds of hacks to cause the 3d view to redraw and show the new state
-        context.scene.render.preview_pixel_size = (
-            context.scene.render.preview_pixel_size
-        )
-        context.active_object.update_tag()
-        context.scene.update_tag()
-        context.view_layer.update()
+        redraw_views(context, [context.object])
         return {"FINISHED"}
 
 
@@ -799,13 +1933,7 @@ class SNAPPER_OT_PointRemove(bpy.types.Operator):
         context.object.snappoints.remove(self.index)
         context.object.active_snappoint = self.index - 1 if self.index else 0
 
-        # all kinds of hacks to cause the 3d view to redraw and show the new state
-        context.scene.render.preview_pixel_size = (
-            context.scene.render.preview_pixel_size
-        )
-        context.active_object.update_tag()
-        context.scene.update_tag()
-        context.view_layer.update()
+        redraw_views(context, [context.object])
 
         return {"FINISHED"}
 
@@ -823,6 +1951,7 @@ class POINTS_UL_Snapper(
             "GRID",
         }:  # we basically ignore the distinction
             # layout.label(text="extra snappoint")
+            icons = get_icons()
             box = layout.box()
             col = box.column()
 
@@ -923,143 +2052,250 @@ class POINTS_UL_Snapper(
         return flt_flags, flt_neworder
 
 
-def dir_is_aligned(ob, ob2, snappoint="A", snappoint2="A"):
-    print(ob, ob2, snappoint, snappoint2)
-    to_direction = (
-        getattr(ob.snapper, snappoint + "_direction")
-        if type(snappoint) == str
-        else ob.snappoints[snappoint].direction
-    )
-    from_direction = (
-        getattr(ob2.snapper, snappoint2 + "_direction")
-        if type(snappoint2) == str
-        else ob2.snappoints[snappoint2].direction
+def snappoint_frame(ob, snappoint):
+    """
+    Return the SnapFrame of a snap-point of ob in local space.
+
+    snappoint is either the letter of a base point or the index of an extra point.
+    """
+    if type(snappoint) == str:
+        return SnapFrame(
+            Vector(getattr(ob.snapper, snappoint + "_location")),
+            Vector(getattr(ob.snapper, snappoint + "_direction")),
+            Vector(getattr(ob.snapper, snappoint + "_up")),
+            getattr(ob.snapper, snappoint + "_snapangle"),
+        )
+    point = ob.snappoints[snappoint]
+    return SnapFrame(
+        Vector(point.location),
+        Vector(point.direction),
+        Vector(point.up),
+        point.snapangle,
     )
 
-    to_direction_ls = Vector(to_direction).to_4d()
-    to_direction_ls.w = 0
-    to_direction_ws = ob.matrix_world @ to_direction_ls
-    from_direction_ls = Vector(from_direction).to_4d()
-    from_direction_ls.w = 0
-    from_direction_ws = ob2.matrix_world @ from_direction_ls
 
-    return to_direction_ws.dot(from_direction_ws) > 0.0
+def dir_is_aligned(ob, ob2, snappoint="A", snappoint2="A"):
+    print(ob, ob2, snappoint, snappoint2)
+    return bool(
+        core.directions_aligned(
+            ob.matrix_world,
+            snappoint_frame(ob, snappoint),
+            ob2.matrix_world,
+            snappoint_frame(ob2, snappoint2),
+        )
+    )
 
 
-def align_objects(ob, ob2, snappoint="A", snappoint2="A", rotsteps=0, flip=False):
+def aligned_matrix(matrix, frame, matrix2, frame2, rotsteps=0, flip=False):
     """
-    Align ob2 to ob1.
+    Return the world matrix that aligns a snap-point of a second object to a snap-point of a first.
 
-    Align snappoint2 in ob2 to snappoint in ob by changing the
-    location and rotation of ob2.
+    matrix and frame are the world matrix of the first object and the SnapFrame
+    of its snap-point, matrix2 and frame2 those of the second object. The
+    second object is moved so that the locations coincide, and rotated so that
+    the principal directions and then the up vectors are aligned.
 
-    Additionally, rotate ob2 by rotsteps around its principal direction.
+    Additionally, the second object is rotated by rotsteps times the snap angle
+    around the principal direction. If flip is True, the principal directions
+    are aligned to be anti-parallel.
 
-    If flip is True, principal directions will be aligned to be anti-parallel.
+    This is the mathutils version of core.aligned_matrices() for a single
+    snap-point, which is a lot cheaper than a batch of one.
 
-    Returns the original angles between the principal directions and the up-vectors.
+    Nothing is changed, the result is a tuple (matrix, principle_angle, up_angle)
+    with the new world matrix and the original angles between the principal
+    directions and the up-vectors.
     """
-    print(f"align {ob2}:{snappoint2} to {ob}:{snappoint} flip={flip}")
-    epsilon = 0.0001
-
-    to_location = (
-        getattr(ob.snapper, snappoint + "_location")
-        if type(snappoint) == str
-        else ob.snappoints[snappoint].location
-    )
-    from_location = (
-        getattr(ob2.snapper, snappoint2 + "_location")
-        if type(snappoint2) == str
-        else ob2.snappoints[snappoint2].location
-    )
-    to_direction = (
-        getattr(ob.snapper, snappoint + "_direction")
-        if type(snappoint) == str
-        else ob.snappoints[snappoint].direction
-    )
-    from_direction = (
-        getattr(ob2.snapper, snappoint2 + "_direction")
-        if type(snappoint2) == str
-        else ob2.snappoints[snappoint2].direction
-    )
-    to_up = (
-        getattr(ob.snapper, snappoint + "_up")
-        if type(snappoint) == str
-        else ob.snappoints[snappoint].up
-    )
-    from_up = (
-        getattr(ob2.snapper, snappoint2 + "_up")
-        if type(snappoint2) == str
-        else ob2.snappoints[snappoint2].up
-    )
-    to_snapangle = (
-        getattr(ob.snapper, snappoint + "_snapangle")
-        if type(snappoint) == str
-        else ob.snappoints[snappoint].snapangle
-    )
-
     # calculate translation
-    to_location_ws = ob.matrix_world @ Vector(to_location)
-    from_location_ws = ob2.matrix_world @ Vector(from_location)
-    translation = to_location_ws - from_location_ws
-
-    ob2.matrix_world = Matrix.Translation(translation) @ ob2.matrix_world
+    to_location_ws = matrix @ frame.location
+    from_location_ws = matrix2 @ frame2.location
+    M = Matrix.Translation(to_location_ws - from_location_ws) @ matrix2
 
     # calculate rotation needed to align principal directions
-    to_direction_ls = Vector(to_direction).to_4d()
-    to_direction_ls.w = 0
-    to_direction_ws = ob.matrix_world @ to_direction_ls
-    from_direction_ls = Vector(from_direction).to_4d()
-    from_direction_ls.w = 0
-    if flip:
-        from_direction_ls = -from_direction_ls
-    from_direction_ws = ob2.matrix_world @ from_direction_ls
+    to_direction_ws = matrix.to_3x3() @ frame.direction
+    from_direction_ws = M.to_3x3() @ (-frame2.direction if flip else frame2.direction)
 
     rot = from_direction_ws.rotation_difference(to_direction_ws)
     principle_angle = abs(rot.angle)
     rotm = rot.to_matrix().to_4x4()
-    if principle_angle < epsilon:
+    if principle_angle < core.EPSILON:
         rotm = Matrix()  # == I(4)
-    elif abs(principle_angle - pi) < epsilon:
-        # rotm = Matrix.Diagonal((-1,-1,-1,1))  # inversion matrix (not to be confused with a inverted matrix)
-        axis = from_direction_ws.to_3d().orthogonal().normalized()
-        rotm = Matrix.Rotation(
-            pi, 4, axis
-        )  # 180 degree rotation around arbitrary axis perp. to directions
-    M = Matrix.Translation(to_location_ws) @ rotm @ Matrix.Translation(-to_location_ws)
-    ob2.matrix_world = M @ ob2.matrix_world
+    elif abs(principle_angle - pi) < core.EPSILON:
+        # 180 degree rotation around arbitrary axis perp. to directions
+        axis = from_direction_ws.orthogonal().normalized()
+        rotm = Matrix.Rotation(pi, 4, axis)
+    M = (
+        Matrix.Translation(to_location_ws)
+        @ rotm
+        @ Matrix.Translation(-to_location_ws)
+        @ M
+    )
+
+    # calculate rotation to align the up vectors
+    to_up_ws = matrix.to_3x3() @ frame.up
+    from_up_ws = M.to_3x3() @ frame2.up
+    rot = from_up_ws.rotation_difference(to_up_ws)
+
+    up_angle = abs(rot.angle)
+
+    if up_angle < core.EPSILON:
+        rot = Quaternion()
+    elif abs(up_angle - pi) < core.EPSILON:
+        # rotation of 180d around direction vector
+        rot = Quaternion(to_direction_ws, pi)
+
+    rot2 = Quaternion()
+    if rotsteps != 0:
+        rot2 = Quaternion(to_direction_ws, frame.snapangle * rotsteps)
+
+    M = (
+        Matrix.Translation(to_location_ws)
+        @ rot2.to_matrix().to_4x4()
+        @ rot.to_matrix().to_4x4()
+        @ Matrix.Translation(-to_location_ws)
+        @ M
+    )
+
+    return M, principle_angle, up_angle
+
+
+def align_objects(ob, ob2, snappoint="A", snappoint2="A", rotsteps=0, flip=False):
+    """
+    Align ob2 to ob1.
+
+    Align snappoint2 in ob2 to snappoint in ob by changing the
+    location and rotation of ob2, see aligned_matrix().
+
+    Returns the original angles between the principal directions and the up-vectors.
+    """
+    print(f"align {ob2}:{snappoint2} to {ob}:{snappoint} flip={flip}")
+    matrix, principle_angle, up_angle = aligned_matrix(
+        ob.matrix_world,
+        snappoint_frame(ob, snappoint),
+        ob2.matrix_world,
+        snappoint_frame(ob2, snappoint2),
+        rotsteps,
+        flip,
+    )
+    ob2.matrix_world = matrix
+    return principle_angle, up_angle
 
-    # calculate rotation to align the up vectors
-    to_up_ls = Vector(to_up).to_4d()
-    to_up_ls.w = 0
-    from_up_ls = Vector(from_up).to_4d()
-    from_up_ls.w = 0
-    to_up_ws = ob.matrix_world @ to_up_ls
-    from_up_ws = ob2.matrix_world @ from_up_ls
-    rot = from_up_ws.rotation_difference(to_up_ws)
 
-    up_angle = abs(rot.angle)
+# a connection for assemble(): snap-point pt of ob is snapped to snap-point
+# target_pt of target, optionally flipped and rotated by rotsteps snap angles
+Connection = namedtuple(
+    "Connection", "ob pt target target_pt flip rotsteps", defaults=(False, 0)
+)
 
-    if up_angle < epsilon:
-        rot = Quaternion()
-    elif abs(up_angle - pi) < epsilon:
-        rot = Quaternion(
-            to_direction_ws.xyz, pi
-        )  # rotation of 180d around direction vector
 
-    rot2 = Quaternion()
-    if rotsteps != 0:
-        rot2 = Quaternion(to_direction_ws, Vector(to_snapangle) * rotsteps)
+def ancestors(ob):
+    """
+    Return the parent of ob, its parent and so on.
+    """
+    parents = []
+    parent = ob.parent
+    while parent is not None:
+        parents.append(parent)
+        parent = parent.parent
+    return parents
 
-    M = (
-        Matrix.Translation(to_location_ws)
-        @ rot2.to_matrix().to_4x4()
-        @ rot.to_matrix().to_4x4()
-        @ Matrix.Translation(-to_location_ws)
-    )
-    ob2.matrix_world = M @ ob2.matrix_world
 
-    return principle_angle, up_angle
+def assemble(connections, apply=True):
+    """
+    Snap objects together without any user interaction.
+
+    connections is an iterable of Connection tuples (or plain tuples with the
+    same fields). Each aligns snap-point pt of ob to snap-point target_pt of
+    target, just like the Snap operator, where snap-points are given as the
+    letter of a base point or the index of an extra point. An object can only
+    be moved by a single connection but it can be the target of any number of
+    them. Objects are aligned after the targets they depend on, so whole
+    chains of objects can be assembled in one call. A target that is not
+    moved itself but is parented to a moved object moves along with it.
+
+    All new world matrices are computed first and then each is written once,
+    unless apply is False. Selection and the active object are not touched,
+    so this works in background mode as well. The world matrices of the
+    objects must be up to date, so call view_layer.update() after creating or
+    moving them.
+
+    Returns a dict that maps the moved objects to their new world matrices.
+    Raises ValueError if an object is moved by more than one connection or if
+    the connections depend on each other in a cycle.
+    """
+    moves = {}
+    for connection in connections:
+        connection = Connection(*connection)
+        key = connection.ob.as_pointer()
+        if key in moves:
+            raise ValueError(
+                f"{connection.ob.name} is moved by more than one connection"
+            )
+        moves[key] = connection
+    if not moves:
+        return {}
+
+    # a connection depends on the connections that move its target or any of
+    # the ancestors of its target
+    dependents = {}
+    waiting = {}
+    ready = []
+    for key, connection in moves.items():
+        depends = [
+            ob.as_pointer()
+            for ob in (connection.target, *ancestors(connection.target))
+            if ob.as_pointer() in moves
+        ]
+        for dependency in depends:
+            dependents.setdefault(dependency, []).append(key)
+        waiting[key] = len(depends)
+        if not depends:
+            ready.append(key)
+
+    def target_matrix(target):
+        for parent in (target, *ancestors(target)):
+            if parent.as_pointer() in matrices:
+                # the target moves along with its (moved) parent
+                return (
+                    matrices[parent.as_pointer()]
+                    @ parent.matrix_world.inverted()
+                    @ target.matrix_world
+                )
+        return target.matrix_world
+
+    # the connections in a level only depend on those in earlier levels, they
+    # are aligned one by one because for a single connection mathutils is a
+    # lot cheaper than numpy, and long chains have a single connection per level
+    matrices = {}
+    while ready:
+        for key in ready:
+            connection = moves[key]
+            matrices[key] = aligned_matrix(
+                target_matrix(connection.target),
+                snappoint_frame(connection.target, connection.target_pt),
+                connection.ob.matrix_world,
+                snappoint_frame(connection.ob, connection.pt),
+                connection.rotsteps,
+                connection.flip,
+            )[0]
+        level, ready = ready, []
+        for key in level:
+            for dependent in dependents.get(key, ()):
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+    if len(matrices) < len(moves):
+        cycle = [moves[key].ob.name for key in moves if key not in matrices]
+        raise ValueError(f"connections form a cycle: {', '.join(cycle)}")
+
+    result = {moves[key].ob: matrix for key, matrix in matrices.items()}
+    if apply:
+        # parents first, because the world matrix of a child is stored
+        # relative to that of its parent
+        for ob in sorted(result, key=lambda ob: len(ancestors(ob))):
+            ob.matrix_world = result[ob]
+    return result
 
 
 # TODO check if unused
@@ -1085,68 +2321,32 @@ def closest_pair(ob, ob2):
     return pair
 
 
-def flip_pair(ob, other_obs, snappoint):
-    epsilon = 0.0001
+def flip_pair(ob, snappoint, view_layer):
+    """
+    Find the snap-point on another visible object that is closest to snappoint on ob.
 
-    if type(snappoint) == str:
-        to_location = Vector(getattr(ob.snapper, snappoint + "_location"))
-    else:
-        to_location = Vector(ob.snappoints[snappoint].location)
-    to_location_ws = ob.matrix_world @ to_location
+    Returns a tuple (ob2, snappoint, snappoint2, to_location_ws, from_location_ws)
+    or None if there are no snap-points on other objects.
+    """
+    to_location_ws = ob.matrix_world @ snappoint_frame(ob, snappoint).location
 
-    # find out which snap-point on another object is closest to the given snap-point
-    distance = 1e30
-    pair = None
-    for ob2 in other_obs:
-        for snappoint2 in POINTS:
-            from_location = snappoint2 + "_location"
-            from_location_ws = ob2.matrix_world @ Vector(
-                getattr(ob2.snapper, from_location)
-            )
-            translation = to_location_ws - from_location_ws
-            d = translation.length
-            if d < distance:
-                distance = d
-                pair = (ob2, snappoint, snappoint2, to_location_ws, from_location_ws)
-        for n, snappoint2 in enumerate(ob2.snappoints):
-            from_location = snappoint2.location
-            from_location_ws = ob2.matrix_world @ Vector(from_location)
-            translation = to_location_ws - from_location_ws
-            d = translation.length
-            if d < distance:
-                distance = d
-                pair = (ob2, snappoint, n, to_location_ws, from_location_ws)
-    return pair
+    snap_index.refresh(view_layer)
+    from_location_ws, index, distance = snap_index.find(
+        to_location_ws, {ob.as_pointer()}
+    )
+    if index is None:
+        return None
+    ob2, snappoint2 = snap_index.entries[index]
+    return (ob2, snappoint, snappoint2, to_location_ws, from_location_ws)
 
 
 def rotate_object(ob, snappoint):
     """
     Rotate ob around the principle axis of the snappoint.
     """
-
-    if type(snappoint) == str:
-        from_location = Vector(getattr(ob.snapper, snappoint + "_location"))
-        from_direction = Vector(getattr(ob.snapper, snappoint + "_direction"))
-        from_snapangle = getattr(ob.snapper, snappoint + "_snapangle")
-    else:
-        from_location = Vector(ob.snappoints[snappoint].location)
-        from_direction = Vector(ob.snappoints[snappoint].direction)
-        from_snapangle = ob.snappoints[snappoint].snapangle
-
-    from_location_ws = ob.matrix_world @ from_location
-
-    from_direction_ls = from_direction.to_4d()
-    from_direction_ls.w = 0
-    from_direction_ws = ob.matrix_world @ from_direction_ls
-
-    rot = Quaternion(from_direction_ws.xyz, from_snapangle)
-
-    M = (
-        Matrix.Translation(from_location_ws)
-        @ rot.to_matrix().to_4x4()
-        @ Matrix.Translation(-from_location_ws)
+    ob.matrix_world = Matrix(
+        core.rotated_matrices(ob.matrix_world, snappoint_frame(ob, snappoint))
     )
-    ob.matrix_world = M @ ob.matrix_world
 
 
 class SNAPPER_OT_Snap(bpy.types.Operator):
@@ -1273,13 +2473,9 @@ class SNAPPER_OT_Flip(bpy.types.Operator):
 
     def execute(self, context):
         ob = context.active_object
-        other_obs = [
-            ob2 for ob2 in context.visible_objects if ob2.snapper.snapper and ob2 != ob
-        ]
-        if other_obs:
-            (ob2, snappoint, snappoint2, to_location_ws, from_location_ws) = flip_pair(
-                ob, other_obs, self.point
-            )
+        pair = flip_pair(ob, self.point, context.view_layer)
+        if pair is not None:
+            ob2, snappoint, snappoint2, to_location_ws, from_location_ws = pair
             is_aligned = dir_is_aligned(
                 ob2, ob, snappoint=snappoint2, snappoint2=snappoint
             )
@@ -1316,13 +2512,9 @@ class SNAPPER_OT_FlipExtra(bpy.types.Operator):
 
     def execute(self, context):
         ob = context.active_object
-        other_obs = [
-            ob2 for ob2 in context.visible_objects if ob2.snapper.snapper and ob2 != ob
-        ]
-        if other_obs:
-            (ob2, snappoint, snappoint2, to_location_ws, from_location_ws) = flip_pair(
-                ob, other_obs, self.point
-            )
+        pair = flip_pair(ob, self.point, context.view_layer)
+        if pair is not None:
+            ob2, snappoint, snappoint2, to_location_ws, from_location_ws = pair
             is_aligned = dir_is_aligned(
                 ob2, ob, snappoint=snappoint2, snappoint2=snappoint
             )
@@ -1763,118 +2955,357 @@ class SNAPPER_OT_SnapEnable(bpy.types.Operator):
         scale = max(0.2, min(context.active_object.dimensions))
         for pt in POINTS:
             setattr(context.active_object.snapper, f"{pt}_gizmoscale", scale)
-        # all kinds of hacks to cause the 3d view to redraw and show the new state
-        context.scene.render.preview_pixel_size = (
-            context.scene.render.preview_pixel_size
-        )
-        context.active_object.update_tag()
-        context.scene.update_tag()
-        context.view_layer.update()
+        redraw_views(context)
         return {"FINISHED"}
 
 
-class SnapModalMixin(bpy.types.Operator):
+def pixel_radius(region, rv3d, location, pixels):
+    """
+    Return the world space distance that spans a number of pixels at the depth of location.
+    """
+    co = view3d_utils.location_3d_to_region_2d(region, rv3d, location)
+    if co is None:  # behind the viewer
+        return 0.0
+    offset = view3d_utils.region_2d_to_location_3d(
+        region, rv3d, co + Vector((pixels, 0)), location
+    )
+    return (offset - location).length
+
+
+def snap_radius(region, rv3d, location):
+    """
+    Return the world space distance within which snap-points snap, for an object at location.
+
+    If the radius is set in pixels, it is converted at the depth of location.
+    """
+    prefs = bpy.context.preferences.addons[__name__].preferences
+    if prefs.snapspace == "SCREEN":
+        return pixel_radius(region, rv3d, location, prefs.snappixels)
+    return prefs.snapradius
+
+
+def orientation_weights(context):
+    """
+    Return the direction and up vector weights for closest_snappoint_pair().
+    """
+    prefs = context.preferences.addons[__name__].preferences
+    if prefs.orientation:
+        return prefs.directionweight, prefs.upweight
+    return 0.0, 0.0
+
+
+def closest_snappoint_pair(
+    matrix,
+    snappoints,
+    exclude,
+    tags=None,
+    radius=2.0,
+    flip=False,
+    direction_weight=0.0,
+    up_weight=0.0,
+):
+    """
+    Find the closest pair of a moving snap-point and a snap-point in the snap index.
+
+    snappoints are the local snap-point arrays of the moving object as returned
+    by snappoint_arrays() and matrix is its world matrix. Targets that belong to
+    an object in exclude are skipped. If tags is given, it is an (m,) array of
+    tag bitmasks (see mask_array()) and a target is only paired with moving
+    snap-points whose tags it accepts, even if incompatible ones are closer.
+    Only pairs closer together than radius are considered.
+
+    Pairs are scored by their distance relative to the radius. A non-zero
+    direction_weight adds a penalty for the amount the principal direction of
+    the moving snap-point must turn to align with the target (anti-parallel if
+    flip is True), so a close target that would spin the object around loses
+    to a slightly more distant one. A non-zero up_weight does the same for the
+    up vectors.
+
+    All candidates near the moving object are fetched with a single range query,
+    so targets further away are never visited, and the scores of all moving
+    snap-points and all candidates are compared at once.
+
+    Returns a tuple (i, from_location, to_location, (ob, pt)), where i is the
+    index of the moving snap-point in the snappoints arrays, or None.
+    """
+    locations, directions, ups, *_ = snappoints
+    if not len(locations):
+        return None
+    points = transform_points(matrix, locations, np.float64)
+    centroid = points.mean(axis=0)
+    spread = np.sqrt(((points - centroid) ** 2).sum(axis=1).max())
+    candidates = snap_index.find_candidates(centroid, spread + radius, exclude)
+    if not len(candidates):
+        return None
+
+    targets = snap_index.locations[candidates]
+    distance = np.linalg.norm(points[:, np.newaxis] - targets[np.newaxis], axis=2)
+    if tags is not None:
+        accepted = (tags[:, np.newaxis] & snap_index.accepttags[candidates]) != 0
+        distance[~accepted] = np.inf
+    score = distance / radius if radius > 0 else distance
+    if direction_weight > 0:
+        direction = transform_directions(matrix, directions, np.float64)
+        alignment = direction @ snap_index.directions[candidates].T
+        score = (
+            score + direction_weight * (1 + alignment if flip else 1 - alignment) / 2
+        )
+    if up_weight > 0:
+        up = transform_directions(matrix, ups, np.float64)
+        alignment = up @ snap_index.ups[candidates].T
+        score = score + up_weight * (1 - alignment) / 2
+    score[~(distance < radius)] = np.inf
+    i, j = np.unravel_index(np.argmin(score), score.shape)
+    if score[i, j] == np.inf:
+        return None
+    return i, Vector(points[i]), Vector(targets[j]), snap_index.entries[candidates[j]]
+
+
+def parent_object(ob, parent):
+    """
+    Parent ob to parent without moving it, like Object > Parent > Object does.
+
+    Only the two objects are touched, selection and the active object are left
+    alone. Nothing happens if parent is ob itself or one of its descendants.
+    """
+    if parent == ob or parent in ob.children_recursive:
+        return
+    matrix = ob.matrix_world.copy()
+    ob.parent = parent
+    ob.matrix_parent_inverse = parent.matrix_world.inverted()
+    # with this parent inverse, the basis matrix is the world matrix
+    ob.matrix_basis = matrix
+
+
+def group_followers(ob, obs):
+    """
+    Return the objects in obs that must be moved explicitly along with ob.
+
+    Objects that have ob or another object in obs as an ancestor move along
+    with their parent anyway and are left out, as are the ancestors of ob.
+    """
+    group = {ob, *obs}
+    ancestors = set()
+    parent = ob.parent
+    while parent is not None:
+        ancestors.add(parent)
+        parent = parent.parent
+    followers = []
+    for ob2 in obs:
+        if ob2 == ob or ob2 in ancestors:
+            continue
+        parent = ob2.parent
+        while parent is not None and parent not in group:
+            parent = parent.parent
+        if parent is None:
+            followers.append(ob2)
+    return followers
+
+
+# mouse moves smaller than this (in pixels) are ignored while dragging
+DRAG_THRESHOLD = 2
+# the minimum and maximum time (in seconds) between processed mouse moves
+DRAG_MIN_INTERVAL = 1 / 120
+DRAG_MAX_INTERVAL = 1 / 10
+
+
+class DragMixin:
+    """
+    Move the active object along with the mouse and look for the closest pair of snap-points.
+
+    Followers, like the other selected objects, keep their transform relative
+    to the active object without being parented to it.
+
+    Mouse moves are coalesced: only the latest position is processed, and no
+    more often than the time it takes to process one allows, so the object
+    does not lag behind the cursor when moving it or finding targets is slow.
+    Pending positions are processed by a timer.
+
+    With the preview preference enabled the objects are not moved at all while
+    dragging. A cached batch of their geometry is drawn instead, aligned to the
+    current target, and the world matrix of the active object is written once,
+    by drag_commit().
+    """
+
+    def drag_start(self, context, event, followers=()):
+        # timers run without a 3d view context, so we keep what we need
+        self.ob = context.object
+        self.area = context.area
+        self.region = context.region
+        self.rv3d = context.region_data
+        self.mouse = self.last_mouse = (event.mouse_x, event.mouse_y)
+        self.matrix = self.ob.matrix_world.copy()
+        # writing world matrices may change the rotation and scale of parented
+        # objects a little, so cancelling restores the complete local transform
+        self.basis = self.ob.matrix_basis.copy()
+        # the followers keep their transform relative to the active object
+        inverse = self.matrix.inverted()
+        self.followers = [
+            (ob, inverse @ ob.matrix_world, ob.matrix_basis.copy()) for ob in followers
+        ]
+        self.ghost = context.preferences.addons[__name__].preferences.ghost
+        if self.ghost:
+            # the active object, the followers and everything parented to them will move
+            obs = [
+                o for ob in (self.ob, *followers) for o in (ob, *ob.children_recursive)
+            ]
+            prefs = context.preferences.addons[__name__].preferences
+            ghost["batch"] = ghost_batch(self.ob, obs, len(obs) > prefs.ghostboxes)
+            ghost["matrix"] = self.matrix
+            # with nothing to preview the objects themselves are moved
+            self.ghost = ghost["batch"] is not None
+        self.last_update = 0.0
+        self.interval = DRAG_MIN_INTERVAL
+        self.target = None
+        self.from_point = None
+        # a single bound method, so it can be recognized as a registered timer
+        self.timer = self.drag_timer
+
+    def drag_event(self, event):
+        self.mouse = (event.mouse_x, event.mouse_y)
+        if bpy.app.timers.is_registered(self.timer):
+            return  # the timer will pick up the latest position
+        wait = self.last_update + self.interval - perf_counter()
+        if wait > 0:
+            bpy.app.timers.register(self.timer, first_interval=wait)
+        else:
+            self.drag_flush()
+
+    def drag_timer(self):
+        self.drag_flush()
+        return None  # do not repeat
+
+    def drag_flush(self):
+        dx = self.mouse[0] - self.last_mouse[0]
+        dy = self.mouse[1] - self.last_mouse[1]
+        if dx * dx + dy * dy < DRAG_THRESHOLD * DRAG_THRESHOLD:
+            return
+        start = perf_counter()
+        self.drag(self.mouse)
+        self.last_mouse = self.mouse
+        self.last_update = perf_counter()
+        self.interval = min(
+            max(2 * (self.last_update - start), DRAG_MIN_INTERVAL), DRAG_MAX_INTERVAL
+        )
+        self.area.tag_redraw()
+
+    def drag_stop(self):
+        if bpy.app.timers.is_registered(self.timer):
+            bpy.app.timers.unregister(self.timer)
+        ghost["batch"] = None
+        ghost["matrix"] = None
+
+    def drag_aligned(self, matrix):
+        """
+        Return the world matrix of the active object at matrix when snapped to the current target.
+        """
+        ob, pt = self.target
+        return aligned_matrix(
+            ob.matrix_world,
+            snappoint_frame(ob, pt),
+            matrix,
+            snappoint_frame(self.ob, self.from_point),
+            flip=self.flip,
+        )[0]
+
+    def drag_commit(self, snap=True):
+        """
+        Write the final world matrix of the active object.
+
+        If snap is True and there is a target, the active object is aligned to
+        it. Either way its world matrix, and that of any follower, is written
+        only once.
+        """
+        matrix = self.matrix
+        if snap and self.target is not None:
+            matrix = self.drag_aligned(matrix)
+        if self.ghost or matrix is not self.matrix:
+            self.ob.matrix_world = matrix
+            for ob, relative, _ in self.followers:
+                ob.matrix_world = matrix @ relative
+
+    def drag_cancel(self):
+        """
+        Move the active object and the followers back to where they were.
+        """
+        self.ob.matrix_basis = self.basis
+        for ob, _, basis in self.followers:
+            ob.matrix_basis = basis
+
+    def drag(self, mouse):
+        global from_point
+        global to_point
+
+        delta = Vector((self.first_mouse[0] - mouse[0], self.first_mouse[1] - mouse[1]))
+        location = view3d_utils.region_2d_to_location_3d(
+            self.region, self.rv3d, self.obj2d - delta, self.matrix.translation
+        )
+        # we keep our own world matrix, because the one of the object is not
+        # updated until the depsgraph is evaluated (and when only the preview
+        # is moved, not at all)
+        mat = self.matrix
+        mat.translation = location
+        if not self.ghost:
+            # the world matrix, because location is in the space of the parent
+            self.ob.matrix_world = mat
+            for ob, relative, _ in self.followers:
+                ob.matrix_world = mat @ relative
+
+        from_point = None
+        to_point = None
+
+        self.target = None
+        self.from_point = None
+        # find closest pair of snappoints
+        pair = closest_snappoint_pair(
+            mat,
+            self.snappoints,
+            self.exclude,
+            self.from_tags if self.match_tags else None,
+            snap_radius(self.region, self.rv3d, location),
+            self.flip,
+            *self.weights,
+        )
+        if pair is not None:
+            i, from_point, to_point, self.target = pair
+            self.from_point = self.snappoint_ids[i]
+        if self.ghost:
+            # show where the objects will end up
+            ghost["matrix"] = mat if self.target is None else self.drag_aligned(mat)
+
+
+class SnapModalMixin(bpy.types.Operator, DragMixin):
     """Snap an object interactively"""
 
     first_mouse: IntVectorProperty(size=2)
-    first_value: FloatVectorProperty()
 
     # TODO set area header with some help text
     def modal(self, context, event):
         global from_point
         global to_point
         if event.type == "MOUSEMOVE":
-            delta = Vector(
-                (
-                    self.first_mouse[0] - event.mouse_x,
-                    self.first_mouse[1] - event.mouse_y,
-                )
-            )
-            region = context.region
-            rv3d = context.region_data
-            context.object.location = view3d_utils.region_2d_to_location_3d(
-                region, rv3d, self.obj2d - delta, context.object.location
-            )
-
-            mat = context.object.matrix_world
-
-            from_point = None
-            to_point = None
-
-            shortest_distance = 1e30  # far, far away
-            self.target_index = None
-            self.target_point = None
-            self.from_point = None
-            # find closest pair of snappoints
-            if self.match_tags:
-                for pt, from_loc in self.snappoints.items():
-                    from_loc_ws = mat @ from_loc
-                    to_loc, index, distance = self.kd.find(from_loc_ws)
-                    if (
-                        distance is not None
-                        and distance < 2
-                        and distance < shortest_distance
-                        and bool(
-                            self.from_tags[pt].intersection(self.target_tags[index])
-                        )
-                    ):  # TODO make this limit configurable
-                        to_point = to_loc
-                        from_point = from_loc_ws
-                        shortest_distance = distance
-                        self.target_index = index
-                        self.from_point = pt
-            else:
-                for pt, from_loc in self.snappoints.items():
-                    from_loc_ws = mat @ from_loc
-                    to_loc, index, distance = self.kd.find(from_loc_ws)
-                    if (  # distance will be None if kd tree is empty
-                        distance is not None
-                        and distance < 2
-                        and distance < shortest_distance
-                    ):  # TODO make this limit configurable
-                        to_point = to_loc
-                        from_point = from_loc_ws
-                        shortest_distance = distance
-                        self.target_index = index
-                        self.from_point = pt
+            self.drag_event(event)
 
         elif event.type == "LEFTMOUSE":
-            if self.target_index is not None:
-                if not event.shift:
-                    # snap objects
-                    if from_point is not None and to_point is not None:
-                        align_objects(
-                            self.target_obs[self.target_index][0],
-                            context.object,
-                            self.target_obs[self.target_index][1],
-                            self.from_point,
-                            flip=self.flip,
-                        )
+            # process the last mouse position before committing
+            self.drag_flush()
+            self.drag_stop()
+            # snap objects (unless shift is held)
+            self.drag_commit(not event.shift)
+            if self.target is not None:
                 # clear highlights
                 from_point = None
                 to_point = None
                 # parent
                 if context.preferences.addons[__name__].preferences.autoparent:
-                    target = self.target_obs[self.target_index][0]
-                    snapped = context.object
-                    for oball in context.scene.objects:
-                        oball.select_set(False)
-                    snapped.select_set(True)
-                    context.view_layer.objects.active = target
-                    bpy.ops.object.parent_set()
-                    context.view_layer.objects.active = snapped
-            # all kinds of hacks to cause the 3d view to redraw and show the new state
-            context.scene.render.preview_pixel_size = (
-                context.scene.render.preview_pixel_size
-            )
-            context.active_object.update_tag()
-            context.scene.update_tag()
-            context.view_layer.update()
+                    parent_object(context.object, self.target[0])
+            redraw_views(context)
             return {"FINISHED"}
 
         elif event.type in {"RIGHTMOUSE", "ESC"}:
-            # reset location of moved object
-            context.object.location = self.first_value
+            self.drag_stop()
+            # reset the moved object
+            self.drag_cancel()
             # clear highlights
             from_point = None
             to_point = None
@@ -1888,86 +3319,28 @@ class SnapModalMixin(bpy.types.Operator):
 
         self.match_tags = context.preferences.addons[__name__].preferences.matchtags
 
-        # create a tree of all snap points world locations and their (snappoint, ob) tuples
-        # first the 4 base points
-        self.target_obs = [
-            (ob, pt)
-            for ob in context.view_layer.objects
-            for pt in POINTS
-            if (
-                ob.snapper.snapper
-                and not ob.hide_get()
-                and not getattr(ob.snapper, f"{pt}_disable")
-                and context.active_object != ob
-            )
-        ]
-        # then the extra points (if any)
-        self.target_obs.extend(
-            [
-                (ob, pt)
-                for ob in context.view_layer.objects
-                for pt in range(len(ob.snappoints))
-                if (
-                    ob.snapper.snapper
-                    and not ob.hide_get()
-                    and not ob.snappoints[pt].disable
-                    and context.active_object != ob
-                )
-            ]
-        )
-
-        self.target_tags = {}
-        self.kd = kdtree.KDTree(len(self.target_obs))
-        for i, (ob, pt) in enumerate(self.target_obs):
-            if type(pt) == str:
-                self.kd.insert(
-                    ob.matrix_world @ Vector(getattr(ob.snapper, f"{pt}_location")), i
-                )
-                tags = getattr(ob.snapper, f"{pt}_accepttags").strip()
-                self.target_tags[i] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
-            else:
-                self.kd.insert(ob.matrix_world @ Vector(ob.snappoints[pt].location), i)
-                tags = ob.snappoints[pt].accepttags.strip()
-                self.target_tags[i] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
-        self.kd.balance()
+        # the snap-points of all other objects are targets
+        self.exclude = {context.object.as_pointer()}
+        snap_index.refresh(context.view_layer, ignore=self.exclude)
 
-        # create a list of all snap points locations and their snappoints for the active object
-        self.snappoints = {}
-        self.from_tags = {}
-        for pt in POINTS:
-            location = getattr(context.object.snapper, f"{pt}_location")
-            if not getattr(context.object.snapper, f"{pt}_disable"):
-                self.snappoints[pt] = Vector(location)
-                tags = getattr(context.object.snapper, f"{pt}_tags").strip()
-                self.from_tags[pt] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
-        for pt in range(len(context.object.snappoints)):
-            p = context.object.snappoints[pt]
-            location = p.location
-            if not p.disable:
-                self.snappoints[pt] = Vector(location)
-                tags = p.tags.strip()
-                self.from_tags[pt] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
+        # the local locations, ids and tags of the snap-points of the active object
+        self.snappoints = snappoint_arrays(context.object)
+        self.snappoint_ids = snappoint_ids(context.object)
+        self.from_tags = mask_array(snappoint_tags(context.object))
 
         # initialize from_point and to_point to None
         from_point = None
         to_point = None
         if context.object:
             self.first_mouse = event.mouse_x, event.mouse_y
-            self.first_value = context.object.location
             region = context.region
             rv3d = context.region_data
             self.obj2d = view3d_utils.location_3d_to_region_2d(
-                region, rv3d, context.object.location
+                region, rv3d, context.object.matrix_world.translation
             )
             self.flip = context.preferences.addons[__name__].preferences.flip
+            self.weights = orientation_weights(context)
+            self.drag_start(context, event)
 
             context.window_manager.modal_handler_add(self)
             return {"RUNNING_MODAL"}
@@ -1976,180 +3349,43 @@ class SnapModalMixin(bpy.types.Operator):
             return {"CANCELLED"}
 
 
-class SnapModalMixinSync(bpy.types.Operator):
+class SnapModalMixinSync(bpy.types.Operator, DragMixin):
     """Snap an active object interactively along with any other selected objects"""
 
     first_mouse: IntVectorProperty(size=2)
-    first_value: FloatVectorProperty()
 
     # TODO set area header with some help text
     def modal(self, context, event):
         global from_point
         global to_point
-        global parented_objects
-        global already_parented_objects
 
         if event.type == "MOUSEMOVE":
-            delta = Vector(
-                (
-                    self.first_mouse[0] - event.mouse_x,
-                    self.first_mouse[1] - event.mouse_y,
-                )
-            )
-            region = context.region
-            rv3d = context.region_data
-            context.object.location = view3d_utils.region_2d_to_location_3d(
-                region, rv3d, self.obj2d - delta, context.object.location
-            )
-
-            mat = context.object.matrix_world
-
-            from_point = None
-            to_point = None
-
-            shortest_distance = 1e30  # far, far away
-            self.target_index = None
-            self.target_point = None
-            self.from_point = None
-            # find closest pair of snappoints
-            if self.match_tags:
-                for pt, from_loc in self.snappoints.items():
-                    from_loc_ws = mat @ from_loc
-                    to_loc, index, distance = self.kd.find(from_loc_ws)
-                    if (
-                        distance is not None
-                        and distance < 2
-                        and distance < shortest_distance
-                        and bool(
-                            self.from_tags[pt].intersection(self.target_tags[index])
-                        )
-                    ):  # TODO make this limit configurable
-                        to_point = to_loc
-                        from_point = from_loc_ws
-                        shortest_distance = distance
-                        self.target_index = index
-                        self.from_point = pt
-            else:
-                for pt, from_loc in self.snappoints.items():
-                    from_loc_ws = mat @ from_loc
-                    to_loc, index, distance = self.kd.find(from_loc_ws)
-                    if (  # distance will be None if kd tree is empty
-                        distance is not None
-                        and distance < 2
-                        and distance < shortest_distance
-                    ):  # TODO make this limit configurable
-                        to_point = to_loc
-                        from_point = from_loc_ws
-                        shortest_distance = distance
-                        self.target_index = index
-                        self.from_point = pt
+            self.drag_event(event)
 
         elif event.type == "LEFTMOUSE":
-            if self.target_index is not None:
-                if not event.shift:
-                    # snap objects
-                    if from_point is not None and to_point is not None:
-                        align_objects(
-                            self.target_obs[self.target_index][0],
-                            context.object,
-                            self.target_obs[self.target_index][1],
-                            self.from_point,
-                            flip=self.flip,
-                        )
+            # process the last mouse position before committing
+            self.drag_flush()
+            self.drag_stop()
+            # snap objects (unless shift is held)
+            self.drag_commit(not event.shift)
+            if self.target is not None:
                 # clear highlights
                 from_point = None
                 to_point = None
-                snapped = context.object
                 # parent
                 if context.preferences.addons[__name__].preferences.autoparent:
-                    target = self.target_obs[self.target_index][0]
-                    for oball in context.scene.objects:
-                        oball.select_set(False)
-                    snapped.select_set(True)
-                    context.view_layer.objects.active = target
-                    bpy.ops.object.parent_set()
-                    context.view_layer.objects.active = snapped
-                # unparent any temporarily parented objects
-                if len(parented_objects):
-                    for oball in context.scene.objects:
-                        oball.select_set(False)
-                    for ob in parented_objects:
-                        ob.select_set(True)
-                    bpy.ops.object.parent_clear(type="CLEAR_KEEP_TRANSFORM")
-                    if False:
-                        # at this point any selected objects that were already parented will have shifted their parent to the snapped object
-                        for ob, parent in already_parented_objects.items():
-                            for oball in context.scene.objects:
-                                oball.select_set(False)
-                            for ob in already_parented_objects:
-                                ob.select_set(True)
-                            bpy.ops.object.parent_clear(type="CLEAR_KEEP_TRANSFORM")
-
-                            for oball in context.scene.objects:
-                                oball.select_set(False)
-                            parent.select_set(True)
-                            ob.select_set(True)
-                            context.view_layer.objects.active = parent
-                            bpy.ops.object.parent_set()
-
-                # reset the pre snap selection situation
-                context.view_layer.objects.active = snapped
-                snapped.select_set(True)
-                for ob in parented_objects:
-                    ob.select_set(True)
-                for ob in already_parented_objects:
-                    ob.select_set(True)
-                parented_objects = None
-                already_parented_objects = None
-
-            # all kinds of hacks to cause the 3d view to redraw and show the new state
-            context.scene.render.preview_pixel_size = (
-                context.scene.render.preview_pixel_size
-            )
-            context.active_object.update_tag()
-            context.scene.update_tag()
-            context.view_layer.update()
+                    parent_object(context.object, self.target[0])
+
+            redraw_views(context)
             return {"FINISHED"}
 
         elif event.type in {"RIGHTMOUSE", "ESC"}:
-            # reset location of moved object
-            context.object.location = self.first_value
+            self.drag_stop()
+            # reset the moved object and the other selected objects
+            self.drag_cancel()
             # clear highlights
             from_point = None
             to_point = None
-            snapped = context.object
-            # unparent any temporarily parented objects
-            if len(parented_objects):
-                for oball in context.scene.objects:
-                    oball.select_set(False)
-                for ob in parented_objects:
-                    ob.select_set(True)
-                bpy.ops.object.parent_clear(type="CLEAR_KEEP_TRANSFORM")
-                if False:
-                    # at this point any selected objects that were already parented will have shifted their parent to the snapped object
-                    for ob, parent in already_parented_objects.items():
-                        for oball in context.scene.objects:
-                            oball.select_set(False)
-                        for ob in already_parented_objects:
-                            ob.select_set(True)
-                        bpy.ops.object.parent_clear(type="CLEAR_KEEP_TRANSFORM")
-
-                        for oball in context.scene.objects:
-                            oball.select_set(False)
-                        parent.select_set(True)
-                        ob.select_set(True)
-                        context.view_layer.objects.active = parent
-                        bpy.ops.object.parent_set()
-
-            # reset the pre snap selection situation
-            context.view_layer.objects.active = snapped
-            snapped.select_set(True)
-            for ob in parented_objects:
-                ob.select_set(True)
-            for ob in already_parented_objects:
-                ob.select_set(True)
-            parented_objects = None
-            already_parented_objects = None
 
             return {"CANCELLED"}
 
@@ -2158,115 +3394,39 @@ class SnapModalMixinSync(bpy.types.Operator):
     def invoke(self, context, event):
         global from_point
         global to_point
-        global parented_objects
-        global already_parented_objects
 
         self.match_tags = context.preferences.addons[__name__].preferences.matchtags
 
-        # create a tree of all snap points world locations and their (snappoint, ob) tuples
-        # but exclude active as well as selected objects
-        # first the 4 base points
-        self.target_obs = [
-            (ob, pt)
-            for ob in context.view_layer.objects
-            for pt in POINTS
-            if (
-                ob.snapper.snapper
-                and not ob.hide_get()
-                and not getattr(ob.snapper, f"{pt}_disable")
-                and context.active_object != ob
-                and ob not in context.selected_objects
-            )
-        ]
-        # then the extra points (if any)
-        self.target_obs.extend(
-            [
-                (ob, pt)
-                for ob in context.view_layer.objects
-                for pt in range(len(ob.snappoints))
-                if (
-                    ob.snapper.snapper
-                    and not ob.hide_get()
-                    and not ob.snappoints[pt].disable
-                    and context.active_object != ob
-                    and ob not in context.selected_objects
-                )
-            ]
-        )
-
-        self.target_tags = {}
-        self.kd = kdtree.KDTree(len(self.target_obs))
-        for i, (ob, pt) in enumerate(self.target_obs):
-            if type(pt) == str:
-                self.kd.insert(
-                    ob.matrix_world @ Vector(getattr(ob.snapper, f"{pt}_location")), i
-                )
-                tags = getattr(ob.snapper, f"{pt}_accepttags").strip()
-                self.target_tags[i] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
-            else:
-                self.kd.insert(ob.matrix_world @ Vector(ob.snappoints[pt].location), i)
-                tags = ob.snappoints[pt].accepttags.strip()
-                self.target_tags[i] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
-        self.kd.balance()
+        # the snap-points of all other objects, except the selected ones, are targets
+        self.exclude = {ob.as_pointer() for ob in context.selected_objects}
+        self.exclude.add(context.object.as_pointer())
+        snap_index.refresh(context.view_layer, ignore=self.exclude)
 
-        # create a list of all snap points locations and their snappoints for the active object
-        self.snappoints = {}
-        self.from_tags = {}
-        for pt in POINTS:
-            location = getattr(context.object.snapper, f"{pt}_location")
-            if not getattr(context.object.snapper, f"{pt}_disable"):
-                self.snappoints[pt] = Vector(location)
-                tags = getattr(context.object.snapper, f"{pt}_tags").strip()
-                self.from_tags[pt] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
-        for pt in range(len(context.object.snappoints)):
-            p = context.object.snappoints[pt]
-            location = p.location
-            if not p.disable:
-                self.snappoints[pt] = Vector(location)
-                tags = p.tags.strip()
-                self.from_tags[pt] = (
-                    set(t.strip() for t in tags.split(",")) if len(tags) else set()
-                )
+        # the local locations, ids and tags of the snap-points of the active object
+        self.snappoints = snappoint_arrays(context.object)
+        self.snappoint_ids = snappoint_ids(context.object)
+        self.from_tags = mask_array(snappoint_tags(context.object))
 
         # initialize from_point and to_point to None
         from_point = None
         to_point = None
         if context.object:
             self.first_mouse = event.mouse_x, event.mouse_y
-            self.first_value = context.object.location
             region = context.region
             rv3d = context.region_data
             self.obj2d = view3d_utils.location_3d_to_region_2d(
-                region, rv3d, context.object.location
+                region, rv3d, context.object.matrix_world.translation
             )
             self.flip = context.preferences.addons[__name__].preferences.flip
+            self.weights = orientation_weights(context)
 
-            # parent any selected objects to the active object
+            # move any selected objects along with the active object
             if context.preferences.addons[__name__].preferences.moveselected:
-                parented_objects = [
-                    ob
-                    for ob in context.selected_objects
-                    if ob != context.active_object and ob.parent is None
-                ]
-                already_parented_objects = {
-                    ob: ob.parent
-                    for ob in context.selected_objects
-                    if ob != context.active_object and ob.parent is not None
-                }
-                for ob in already_parented_objects:
-                    ob.select_set(False)
-                if len(parented_objects):
-                    bpy.ops.object.parent_set()
+                followers = group_followers(context.object, context.selected_objects)
             else:
-                parented_objects = []
-                already_parented_objects = {}
+                followers = []
 
+            self.drag_start(context, event, followers)
             context.window_manager.modal_handler_add(self)
             return {"RUNNING_MODAL"}
         else:
@@ -2341,8 +3501,10 @@ class SNAPPER_OT_Copy(bpy.types.Operator):
 
     def execute(self, context):
         snap_src = context.active_object.snapper
+        changed = []
         for ob in context.selected_objects:
             if ob is not context.active_object:
+                changed.append(ob)
                 snap_dst = ob.snapper
                 snap_dst.snapper = snap_src.snapper
                 for point in POINTS:
@@ -2380,13 +3542,7 @@ class SNAPPER_OT_Copy(bpy.types.Operator):
                         "accepttags",
                     ):
                         setattr(pt, attr, getattr(point, attr))
-        # all kinds of hacks to cause the 3d view to redraw and show the new state
-        context.scene.render.preview_pixel_size = (
-            context.scene.render.preview_pixel_size
-        )
-        context.active_object.update_tag()
-        context.scene.update_tag()
-        context.view_layer.update()
+        redraw_views(context, changed)
         return {"FINISHED"}
 
 
@@ -2407,78 +3563,36 @@ class SNAPPER_OT_Select(bpy.types.Operator):
         return len(context.selected_objects) > 0
 
     def execute(self, context):
-        while True:
-            # create a tree of all (non-selected) snap points world locations and their (snappoint, ob) tuples
-            self.target_obs = [
-                (ob, pt)
-                for ob in context.view_layer.objects
-                for pt in POINTS
-                if (
-                    ob.snapper.snapper
-                    and not ob.hide_get()
-                    and not getattr(ob.snapper, f"{pt}_disable")
-                    and ob not in context.selected_objects
-                )
-            ]
-            self.target_obs.extend(
-                [
-                    (ob, pt)
-                    for ob in context.view_layer.objects
-                    for pt in range(len(ob.snappoints))
-                    if (
-                        ob.snapper.snapper
-                        and not ob.hide_get()
-                        and not ob.snappoints[pt].disable
-                        and context.active_object != ob
-                    )
-                ]
-            )
-            if len(self.target_obs) < 1:
-                break
+        snap_index.refresh(context.view_layer)
+        if self.all:
+            # this may query the snap-points of every object, and each query
+            # searches the whole overlay of the index by brute force
+            snap_index.compact()
+        selected = {ob.as_pointer() for ob in context.selected_objects}
+        # the objects whose neighbors we look for
+        obs = context.selected_objects
+        while obs:
+            # find overlapping snap-points on non-selected objects
+            neighbors = []
+            for ob in obs:
+                _, locations = snap_index.object_locations(ob)
+                if locations is None:
+                    continue
+                for point in locations.tolist():
+                    for to_loc, index, distance in snap_index.find_range(
+                        point, 0.0001, selected
+                    ):
+                        neighbor = snap_index.entries[index][0]
+                        if neighbor.as_pointer() not in selected:
+                            neighbor.select_set(True)
+                            selected.add(neighbor.as_pointer())
+                            neighbors.append(neighbor)
 
-            self.kd = kdtree.KDTree(len(self.target_obs))
-            for i, (ob, pt) in enumerate(self.target_obs):
-                if type(pt) == str:
-                    self.kd.insert(
-                        ob.matrix_world @ Vector(getattr(ob.snapper, f"{pt}_location")),
-                        i,
-                    )
-                else:
-                    self.kd.insert(
-                        ob.matrix_world @ Vector(ob.snappoints[pt].location), i
-                    )
-            self.kd.balance()
-
-            # create a list of all snap points locations and their snappoints for the selected objects
-            self.snappoints = []
-            for ob in context.selected_objects:
-                if ob.snapper.snapper:
-                    for pt in POINTS:
-                        location = getattr(ob.snapper, f"{pt}_location")
-                        if not getattr(ob.snapper, f"{pt}_disable"):
-                            self.snappoints.append(ob.matrix_world @ Vector(location))
-                    for pt in range(len(ob.snappoints)):
-                        p = ob.snappoints[pt]
-                        location = p.location
-                        self.snappoints.append(ob.matrix_world @ Vector(location))
-
-            # find overlapping snap-points
-            new = 0
-            for point in self.snappoints:
-                for to_loc, index, distance in self.kd.find_range(point, 0.0001):
-                    self.target_obs[index][0].select_set(True)
-                    new += 1
-
-            if not self.all or new == 0:
+            if not self.all:
                 break
+            obs = neighbors
 
-        # all kinds of hacks to cause the 3d view to redraw and show the new state
-        context.scene.render.preview_pixel_size = (
-            context.scene.render.preview_pixel_size
-        )
-        context.active_object.update_tag()
-        context.scene.update_tag()
-        context.view_layer.update()
+        redraw_views(context)
         return {"FINISHED"}
 
 
@@ -2530,6 +3644,60 @@ class SNAPPER_OT_CursorExtra(bpy.types.Operator):
         return {"FINISHED"}
 
 
+class SNAPPER_OT_DumpCapture(bpy.types.Operator):
+    bl_idname = "object.snapper_dump_capture"
+    bl_label = "Capture"
+    bl_options = {"REGISTER"}
+    bl_description = "Capture transformation data of snap-points in the next redraws"
+
+    frames: IntProperty(
+        name="Frames", default=1, min=1, description="Number of redraws to capture"
+    )
+
+    @classmethod
+    def poll(self, context):
+        prefs = context.preferences.addons[__name__].preferences
+        return prefs.debug and prefs.dump
+
+    def execute(self, context):
+        global dump_log
+        prefs = context.preferences.addons[__name__].preferences
+        if dump_log.maxlen != prefs.dumpsize:
+            dump_log = deque(dump_log, maxlen=prefs.dumpsize)
+        dump_state["frames"] = self.frames
+        for window in context.window_manager.windows:
+            for area in window.screen.areas:
+                if area.type == "VIEW_3D":
+                    area.tag_redraw()
+        return {"FINISHED"}
+
+
+class SNAPPER_OT_DumpWrite(bpy.types.Operator, ExportHelper):
+    bl_idname = "object.snapper_dump_write"
+    bl_label = "Write log"
+    bl_options = {"REGISTER"}
+    bl_description = "Write the captured transformation data to a file"
+
+    filename_ext = ".txt"
+    filter_glob: StringProperty(default="*.txt", options={"HIDDEN"})
+    clear: BoolProperty(
+        name="Clear", default=True, description="Clear the log after writing it"
+    )
+
+    @classmethod
+    def poll(self, context):
+        return len(dump_log) > 0
+
+    def execute(self, context):
+        with open(self.filepath, "w") as f:
+            f.write(format_dump_log())
+        self.report({"INFO"}, f"{len(dump_log)} log entries written to {self.filepath}")
+        if self.clear:
+            dump_log.clear()
+            dump_state["frame"] = 0
+        return {"FINISHED"}
+
+
 class SNAPPER_MT_Pie(Menu):
     bl_label = "Snap!"
 
@@ -2579,6 +3747,11 @@ class SnapperPreferences(bpy.types.AddonPreferences):
     visible: BoolProperty(
         name="Visible", description="Uncheck to hide all snappoints", default=True
     )
+    showall: BoolProperty(
+        name="Show all",
+        description="Show all snap-points in the scene as dots, colored by their state",
+        default=False,
+    )
     shortcut: BoolProperty(
         name="Create Ctrl-K Shortcut",
         description="Create Ctrl-K shortcut for interactive snapping",
@@ -2631,6 +3804,34 @@ class SnapperPreferences(bpy.types.AddonPreferences):
         description="Color of interactive target",
         subtype="COLOR",
     )
+    connectedcolor: FloatVectorProperty(
+        name="Connected",
+        size=4,
+        default=(0, 1, 0, 1),
+        description="Color of connected snap-points when all snap-points are shown",
+        subtype="COLOR",
+    )
+    opencolor: FloatVectorProperty(
+        name="Open",
+        size=4,
+        default=(1, 0.5, 0, 1),
+        description="Color of open snap-points when all snap-points are shown",
+        subtype="COLOR",
+    )
+    disabledcolor: FloatVectorProperty(
+        name="Disabled",
+        size=4,
+        default=(0.5, 0.5, 0.5, 0.5),
+        description="Color of disabled snap-points when all snap-points are shown",
+        subtype="COLOR",
+    )
+    overviewsize: IntProperty(
+        name="Size",
+        description="Size of the dots when all snap-points are shown",
+        default=6,
+        min=1,
+        soft_max=20,
+    )
     linewidth: IntProperty(
         name="Linewidth",
         description="Linewidth of arrows",
@@ -2675,6 +3876,68 @@ class SnapperPreferences(bpy.types.AddonPreferences):
         description="Only snap points with matching tags",
         default=False,
     )
+    snapspace: EnumProperty(
+        name="Snap within",
+        description="How the distance within which snap-points snap is measured",
+        items=[
+            ("WORLD", "World", "Snap within a distance in world units"),
+            ("SCREEN", "Screen", "Snap within a distance in pixels"),
+        ],
+        default="WORLD",
+    )
+    snapradius: FloatProperty(
+        name="Radius",
+        description="Snap-points closer together than this distance snap",
+        default=2.0,
+        min=0.0,
+        soft_max=100.0,
+        subtype="DISTANCE",
+    )
+    snappixels: IntProperty(
+        name="Pixels",
+        description="Snap-points closer together on screen than this (in pixels) snap",
+        default=40,
+        min=1,
+        soft_max=500,
+    )
+    ghost: BoolProperty(
+        name="Preview",
+        description="Drag a preview while snapping interactively and move the objects only when done",
+        default=False,
+    )
+    ghostcolor: FloatVectorProperty(
+        name="Color",
+        size=4,
+        default=(1, 1, 1, 0.3),
+        description="Color of the preview",
+        subtype="COLOR",
+    )
+    ghostboxes: IntProperty(
+        name="Boxes",
+        description="Preview groups of more objects than this as bounding boxes",
+        default=20,
+        min=0,
+        soft_max=200,
+    )
+    orientation: BoolProperty(
+        name="Prefer aligned",
+        description="Prefer targets that need the least rotation over targets that are merely closer",
+        default=False,
+    )
+    directionweight: FloatProperty(
+        name="Direction",
+        description="Penalty for a principal direction that must turn around, relative to the snap radius",
+        default=1.0,
+        min=0.0,
+        soft_max=5.0,
+    )
+    upweight: FloatProperty(
+        name="Up",
+        description="Penalty for an up vector that must turn around, relative to the snap radius",
+        default=0.0,
+        min=0.0,
+        soft_max=5.0,
+    )
 
     debug: BoolProperty(
         name="Debug",
@@ -2694,21 +3957,92 @@ class SnapperPreferences(bpy.types.AddonPreferences):
         default=False,
     )
 
+    lod: BoolProperty(
+        name="Level of detail",
+        description="Simplify or hide snap-points that are small on screen",
+        default=True,
+    )
+    lodarrows: IntProperty(
+        name="Arrows",
+        description="Snap-points smaller than this (in pixels) are drawn as a dot",
+        default=16,
+        min=0,
+        soft_max=200,
+    )
+    loddots: IntProperty(
+        name="Dots",
+        description="Snap-points smaller than this (in pixels) are not drawn at all",
+        default=2,
+        min=0,
+        soft_max=50,
+    )
+    labelfade: IntProperty(
+        name="Fade labels",
+        description="Labels of snap-points smaller than this (in pixels) start to fade",
+        default=32,
+        min=0,
+        soft_max=200,
+    )
+    declutter: BoolProperty(
+        name="Declutter labels",
+        description="Draw only one label where labels would overlap",
+        default=True,
+    )
+    declutter_cellsize: IntProperty(
+        name="Spacing",
+        description="Labels closer together than this (in pixels) may overlap",
+        default=24,
+        min=1,
+        soft_max=200,
+    )
+    declutter_count: BoolProperty(
+        name="Count",
+        description="Add the number of hidden labels to a decluttered label",
+        default=True,
+    )
+    labelhide: IntProperty(
+        name="Hide labels",
+        description="Labels of snap-points smaller than this (in pixels) are not drawn",
+        default=8,
+        min=0,
+        soft_max=200,
+    )
+
+    profile: BoolProperty(
+        name="Timing",
+        description="Show the time spent drawing snap-points and labels in the 3d view",
+        default=False,
+    )
+
     dump: BoolProperty(
         name="Dump",
-        description="Log transformation data of arrowheads to console (very verbose!)",
+        description="Capture transformation data of arrowheads on demand in a log",
         default=False,
     )
 
+    dumpsize: IntProperty(
+        name="Log size",
+        description="Maximum number of captured objects kept in the log",
+        default=1000,
+        min=1,
+    )
+
     def draw(self, context):
         layout = self.layout
         row = layout.row()
         row.prop(self, "visible")
+        row.prop(self, "showall")
         row.prop(self, "shortcut")
         row = layout.row(heading="Labels")
         row.prop(self, "fontsize", text="Size")
         row.prop(self, "fontshadow", text="Shadow")
         row.prop(self, "labeloffset", text="Offset")
+        row = layout.row(heading="Declutter")
+        row.prop(self, "declutter", text="")
+        sub = row.row()
+        sub.enabled = self.declutter
+        sub.prop(self, "declutter_cellsize")
+        sub.prop(self, "declutter_count")
         row = layout.row(heading="Label color")
         row.prop(self, "coloroverride")
         row.prop(self, "replacementcolor", text="")
@@ -2723,12 +4057,45 @@ class SnapperPreferences(bpy.types.AddonPreferences):
         col1.prop(self, "conescale")
         col2.prop(self, "fromcolor")
         col2.prop(self, "tocolor")
+        col3 = row.box().column(heading="Show all", align=True)
+        col3.prop(self, "connectedcolor")
+        col3.prop(self, "opencolor")
+        col3.prop(self, "disabledcolor")
+        col3.separator()
+        col3.prop(self, "overviewsize")
+        row = layout.row()
+        col = row.box().column(heading="Level of detail", align=True)
+        col.prop(self, "lod")
+        col = col.column(align=True)
+        col.enabled = self.lod
+        col.prop(self, "lodarrows")
+        col.prop(self, "loddots")
+        col.prop(self, "labelfade")
+        col.prop(self, "labelhide")
         row = layout.row()
         col = row.box().column(heading="Behavior", align=True)
         col.prop(self, "flip")
         col.prop(self, "autoparent")
         col.prop(self, "moveselected")
         col.prop(self, "matchtags")
+        row = col.row(heading="Preview", align=True)
+        row.prop(self, "ghost", text="")
+        sub = row.row(align=True)
+        sub.enabled = self.ghost
+        sub.prop(self, "ghostcolor", text="")
+        sub.prop(self, "ghostboxes")
+        col.separator()
+        col.prop(self, "snapspace", expand=True)
+        if self.snapspace == "WORLD":
+            col.prop(self, "snapradius")
+        else:
+            col.prop(self, "snappixels")
+        col.separator()
+        col.prop(self, "orientation")
+        sub = col.column(align=True)
+        sub.enabled = self.orientation
+        sub.prop(self, "directionweight")
+        sub.prop(self, "upweight")
         row = layout.row()
         col = row.box().column(heading="Developer", align=True)
         col.prop(self, "debug")
@@ -2736,6 +4103,16 @@ class SnapperPreferences(bpy.types.AddonPreferences):
             col.prop(self, "nocones")
             col.prop(self, "noarrows")
             col.prop(self, "dump")
+            if self.dump:
+                row = col.row(align=True)
+                row.prop(self, "dumpsize")
+                row.operator("object.snapper_dump_capture", text="Capture frame")
+                op = row.operator(
+                    "object.snapper_dump_capture", text="Capture 10 frames"
+                )
+                op.frames = 10
+                row.operator("object.snapper_dump_write", icon="EXPORT")
+            col.prop(self, "profile")
 
 
 classes = (
@@ -2771,6 +4148,8 @@ classes = (
     SNAPPER_OT_Select,
     SNAPPER_OT_Cursor,
     SNAPPER_OT_CursorExtra,
+    SNAPPER_OT_DumpCapture,
+    SNAPPER_OT_DumpWrite,
     SNAPPER_OT_PointAdd,
     SNAPPER_OT_PointRemove,
 )
@@ -2779,7 +4158,7 @@ classes = (
 def register():
     global handler
     global label_handler
-    global icons
+    global stats_handler
     global from_point
     global to_point
     from_point = None
@@ -2793,24 +4172,43 @@ def register():
     bpy.types.Object.active_snappoint = bpy.props.IntProperty(
         name="Active", default=0
     )  # , update=index_changed)
-    icons = load_icons()
-    handler = bpy.types.SpaceView3D.draw_handler_add(
-        draw_handler_post_view, (), "WINDOW", "POST_VIEW"
-    )
-    label_handler = bpy.types.SpaceView3D.draw_handler_add(
-        draw_handler_post_pixel, (), "WINDOW", "POST_PIXEL"
-    )
+    handler = label_handler = stats_handler = None
+    # there are no viewports to draw in when running in background mode
+    if not bpy.app.background:
+        handler = bpy.types.SpaceView3D.draw_handler_add(
+            draw_handler_post_view, (), "WINDOW", "POST_VIEW"
+        )
+        label_handler = bpy.types.SpaceView3D.draw_handler_add(
+            draw_handler_post_pixel, (), "WINDOW", "POST_PIXEL"
+        )
+        stats_handler = bpy.types.SpaceView3D.draw_handler_add(
+            draw_handler_stats, (), "WINDOW", "POST_PIXEL"
+        )
     update_shortcut(None, bpy.context)
+    bpy.app.handlers.depsgraph_update_post.append(gizmo_cache_update)
+    bpy.app.handlers.frame_change_post.append(gizmo_cache_clear)
+    bpy.app.handlers.undo_post.append(gizmo_cache_clear)
+    bpy.app.handlers.redo_post.append(gizmo_cache_clear)
+    bpy.app.handlers.load_post.append(gizmo_cache_clear)
 
 
 def unregister():
     global handler
     global label_handler
+    global stats_handler
     global icons
+    bpy.app.handlers.depsgraph_update_post.remove(gizmo_cache_update)
+    bpy.app.handlers.frame_change_post.remove(gizmo_cache_clear)
+    bpy.app.handlers.undo_post.remove(gizmo_cache_clear)
+    bpy.app.handlers.redo_post.remove(gizmo_cache_clear)
+    bpy.app.handlers.load_post.remove(gizmo_cache_clear)
+    gizmo_cache_clear()
     if handler is not None:
         bpy.types.SpaceView3D.draw_handler_remove(handler, "WINDOW")
     if label_handler is not None:
         bpy.types.SpaceView3D.draw_handler_remove(label_handler, "WINDOW")
+    if stats_handler is not None:
+        bpy.types.SpaceView3D.draw_handler_remove(stats_handler, "WINDOW")
     if icons:
         bpy.utils.previews.remove(icons)
     icons = None
@@ -0,0 +1,267 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  Snap!, position modular assets with ease.
+#  (c) 2021 - 2025 Michel Anders (varkenvarken)
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+Snap-point math on plain numpy arrays.
+
+Nothing in here depends on bpy or mathutils, so it can be used outside
+Blender as well. A snap-point is described by a SnapFrame, with its location,
+direction and up vector in the local space of its object, and its snap angle.
+World matrices are 4x4 arrays.
+
+All functions work on batches: the fields of a SnapFrame may be (n, 3)
+arrays (and an (n,) array of snap angles) and matrices (n, 4, 4) arrays, and
+every argument is broadcast against the others, so a single matrix can be
+combined with many frames. Unbatched arguments give unbatched results.
+mathutils Vectors and Matrices are accepted wherever an array is expected.
+"""
+
+from collections import namedtuple
+from math import pi
+
+import numpy as np
+
+# angles closer than this to 0 or 180 degrees are treated as exactly that
+EPSILON = 0.0001
+
+# the location, direction and up vector of a snap-point and its snap angle
+SnapFrame = namedtuple("SnapFrame", "location direction up snapangle")
+
+# for each dominant axis the matrix that maps a vector to one perpendicular to
+# it, see orthogonal()
+ORTHOGONAL = np.array(
+    [
+        [[0, -1, -1], [1, 0, 0], [1, 0, 0]],
+        [[0, 1, 0], [-1, 0, -1], [0, 1, 0]],
+        [[0, 0, 1], [0, 0, 1], [-1, -1, 0]],
+    ],
+    dtype=np.float64,
+)
+
+# the Levi-Civita symbol, contracting it with a vector gives the matrix of its
+# cross product, see rotation_matrices()
+LEVI_CIVITA = np.zeros((3, 3, 3))
+LEVI_CIVITA[(0, 1, 2), (1, 2, 0), (2, 0, 1)] = 1
+LEVI_CIVITA[(0, 1, 2), (2, 0, 1), (1, 2, 0)] = -1
+
+
+def stack_frames(frames):
+    """
+    Combine a sequence of SnapFrames into a single SnapFrame of arrays.
+    """
+    location, direction, up, snapangle = zip(*frames)
+    return SnapFrame(
+        np.array(location, dtype=np.float64),
+        np.array(direction, dtype=np.float64),
+        np.array(up, dtype=np.float64),
+        np.array(snapangle, dtype=np.float64),
+    )
+
+
+def lengths(vectors):
+    """
+    Return the lengths of vectors.
+    """
+    return np.sqrt(np.einsum("...i,...i", vectors, vectors))
+
+
+def normalized(vectors):
+    """
+    Return vectors scaled to unit length, vectors of length zero stay zero.
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    length = lengths(vectors)[..., None]
+    return np.divide(vectors, length, out=np.zeros_like(vectors), where=length > 0)
+
+
+def orthogonal(vectors):
+    """
+    Return vectors perpendicular to vectors, just like mathutils Vector.orthogonal().
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    magnitude = np.abs(vectors)
+    x, y, z = magnitude[..., 0], magnitude[..., 1], magnitude[..., 2]
+    # the dominant axis, with ties going to the last one
+    dominant = np.where(x > y, np.where(x > z, 0, 2), np.where(y > z, 1, 2))
+    return (ORTHOGONAL[dominant] @ vectors[..., None])[..., 0]
+
+
+def rotation_difference(vectors, vectors2):
+    """
+    Return the rotation that turns vectors into vectors2.
+
+    The result is a tuple (axes, angles) with angles between 0 and pi, the axes
+    are not normalized. Just like mathutils Vector.rotation_difference() the
+    lengths of the vectors are ignored.
+    """
+    vectors = normalized(vectors)
+    vectors2 = normalized(vectors2)
+    axes = np.einsum("ijk,...j,...k->...i", LEVI_CIVITA, vectors, vectors2)
+    angles = np.arctan2(lengths(axes), np.einsum("...i,...i", vectors, vectors2))
+    return axes, angles
+
+
+def rotation_matrices(axes, angles):
+    """
+    Return 3x3 matrices that rotate by angles around axes.
+
+    The axes need not be normalized, a zero axis gives the identity.
+    """
+    axes = normalized(axes)
+    angles = np.asarray(angles, dtype=np.float64)
+    c, s = np.cos(angles)[..., None, None], np.sin(angles)[..., None, None]
+    # Rodrigues' rotation formula, a zero axis would leave just c * I so we
+    # use c = 1 for those
+    c = np.where(lengths(axes)[..., None, None] > 0, c, 1.0)
+    cross = np.einsum("ijk,...j->...ik", LEVI_CIVITA, axes)
+    outer = axes[..., :, None] * axes[..., None, :]
+    return c * np.eye(3) + s * cross + (1 - c) * outer
+
+
+def world_matrices(rotations, locations):
+    """
+    Return 4x4 matrices with 3x3 rotations (or any linear map) and translations.
+    """
+    shape = np.broadcast_shapes(rotations.shape[:-2], locations.shape[:-1])
+    M = np.zeros(shape + (4, 4))
+    M[..., :3, :3] = rotations
+    M[..., :3, 3] = locations
+    M[..., 3, 3] = 1
+    return M
+
+
+def transform_points(matrices, points):
+    """
+    Return points transformed by 4x4 matrices.
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    return (matrices[..., :3, :3] @ points[..., None])[..., 0] + matrices[..., :3, 3]
+
+
+def transform_directions(matrices, directions):
+    """
+    Return directions transformed by the 3x3 part of 4x4 matrices.
+
+    Unlike points the result is not translated, nor is it normalized.
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    directions = np.asarray(directions, dtype=np.float64)
+    return (matrices[..., :3, :3] @ directions[..., None])[..., 0]
+
+
+def directions_aligned(matrices, frames, matrices2, frames2):
+    """
+    Return True where the principal directions of two snap-points point the same way.
+    """
+    direction = transform_directions(matrices, frames.direction)
+    direction2 = transform_directions(matrices2, frames2.direction)
+    return np.einsum("...i,...i", direction, direction2) > 0.0
+
+
+def aligned_matrices(matrices, frames, matrices2, frames2, rotsteps=0, flip=False):
+    """
+    Return the world matrices that align snap-points of second objects to snap-points of first ones.
+
+    matrices and frames are the world matrices of the first objects and the
+    SnapFrames of their snap-points, matrices2 and frames2 those of the second
+    objects. The second objects are moved so that the locations coincide, and
+    rotated so that the principal directions and then the up vectors are
+    aligned. Directions that are (anti-)parallel within EPSILON radians are
+    treated the same way as mathutils does.
+
+    Additionally, the second objects are rotated by rotsteps times the snap
+    angle around the principal direction. Where flip is True, the principal
+    directions are aligned to be anti-parallel.
+
+    The result is a tuple (matrices, principle_angles, up_angles) with the new
+    world matrices and the original angles between the principal directions
+    and the up-vectors.
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    linear2 = np.asarray(matrices2, dtype=np.float64)[..., :3, :3]
+    location2 = np.asarray(frames2.location, dtype=np.float64)
+    direction2 = np.asarray(frames2.direction, dtype=np.float64)
+    flip = np.asarray(flip, dtype=bool)
+
+    to_location = transform_points(matrices, frames.location)
+    to_direction = transform_directions(matrices, frames.direction)
+    to_up = transform_directions(matrices, frames.up)
+
+    # calculate rotation needed to align principal directions
+    from_direction = (
+        linear2 @ np.where(flip[..., None], -direction2, direction2)[..., None]
+    )[..., 0]
+    axes, principle_angles = rotation_difference(from_direction, to_direction)
+    # a 180 degree rotation around an arbitrary axis perpendicular to the directions
+    opposed = np.abs(principle_angles - pi) < EPSILON
+    axes = np.where(opposed[..., None], orthogonal(from_direction), axes)
+    angles = np.where(
+        principle_angles < EPSILON, 0.0, np.where(opposed, pi, principle_angles)
+    )
+    rotation = rotation_matrices(axes, angles)
+
+    # calculate rotation to align the up vectors
+    from_up = transform_directions(rotation @ linear2, frames2.up)
+    axes, up_angles = rotation_difference(from_up, to_up)
+    # a 180 degree rotation around the principal direction
+    opposed = np.abs(up_angles - pi) < EPSILON
+    axes = np.where(opposed[..., None], to_direction, axes)
+    angles = np.where(up_angles < EPSILON, 0.0, np.where(opposed, pi, up_angles))
+
+    steps = rotation_matrices(
+        to_direction, np.asarray(frames.snapangle, dtype=np.float64) * rotsteps
+    )
+    linear = steps @ rotation_matrices(axes, angles) @ rotation @ linear2
+
+    # all rotations are around the target location, so that is where the
+    # snap-point ends up
+    M = world_matrices(linear, to_location - (linear @ location2[..., None])[..., 0])
+    return M, principle_angles, up_angles
+
+
+def aligned_matrix(matrix, frame, matrix2, frame2, rotsteps=0, flip=False):
+    """
+    Return the world matrix that aligns a snap-point of a second object to a snap-point of a first.
+
+    This is the unbatched version of aligned_matrices(), the result is a tuple
+    (matrix, principle_angle, up_angle) with a 4x4 array and two floats.
+    """
+    M, principle_angle, up_angle = aligned_matrices(
+        matrix, frame, matrix2, frame2, rotsteps, flip
+    )
+    return M, float(principle_angle), float(up_angle)
+
+
+def rotated_matrices(matrices, frames, steps=1):
+    """
+    Return world matrices rotated by steps times the snap angle around the principal direction of snap-points.
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    location = transform_points(matrices, frames.location)
+    direction = transform_directions(matrices, frames.direction)
+    angles = np.asarray(frames.snapangle, dtype=np.float64) * steps
+    rotation = rotation_matrices(direction, angles)
+    # rotate around the snap-point, so that stays where it is
+    return world_matrices(
+        rotation @ matrices[..., :3, :3],
+        location + (rotation @ (matrices[..., :3, 3] - location)[..., None])[..., 0],
+    )